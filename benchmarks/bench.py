@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of the plugin hot paths, run against the mock CARTO
+server in mockserver.py. They need a Python environment where QGIS can be
+imported, and no CARTO account:
+
+    python benchmarks/bench.py --rows 100000 --latency 50
+
+Each benchmark runs in its own process, so its peak memory can be
+measured. Results are printed as a table, or as JSON with --json, to
+compare them across branches.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mockserver import (  # noqa: E402
+    CONNECTION_NAME,
+    DATABASE,
+    SCHEMA,
+    MockCartoServer,
+    create_sample_table,
+)
+
+BENCHMARKS = ["download", "import", "upload", "tiles"]
+# zoom level of the tiles fetched by the tiles benchmark
+TILES_ZOOM = 2
+
+
+def _peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _server_stats(url, reset=False):
+    with urllib.request.urlopen(url + ("_reset" if reset else "_stats")) as response:
+        return json.loads(response.read())
+
+
+def _timed(url, func):
+    """
+    Runs a benchmarked operation, after resetting the server stats so they
+    only count the requests made by it. Returns its result and duration
+    """
+    _server_stats(url, reset=True)
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def _init_qgis(profile):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from qgis.core import QgsApplication
+
+    app = QgsApplication([], False, profile)
+    app.initQgis()
+    return app
+
+
+def _configure_api(url):
+    import yaml
+    from carto.core.api import CARTO_API
+
+    CARTO_API.set_token("mock")
+    config = yaml.safe_load(CARTO_API.get(url + "config.yaml").text)
+    CARTO_API.workspace_url = config["apis"]["workspaceUrl"]
+    CARTO_API.base_url = config["apis"]["baseUrl"]
+
+
+class _HeadlessInterface:
+    """
+    Replaces the QGIS interface used to report results to the user, which
+    doesn't exist when running outside of the QGIS application
+    """
+
+    def messageBar(self):
+        return self
+
+    def pushMessage(self, *args, **kwargs):
+        pass
+
+
+def _table():
+    from carto.core.connection import ProviderConnection
+
+    connection = ProviderConnection(CONNECTION_NAME, CONNECTION_NAME, "postgres")
+    schema = connection.databases()[0].schemas()[0]
+    return next(table for table in schema.tables() if table.tableid == "points")
+
+
+def _download(rows):
+    from carto.core.downloadtabletask import DownloadTableTask
+
+    task = DownloadTableTask(_table(), "TRUE", rows)
+    if not task.run():
+        raise Exception(task.exception)
+    return task.layer
+
+
+def bench_download(args):
+    layer, seconds = _timed(args.url, lambda: _download(args.rows))
+    return layer.featureCount(), seconds
+
+
+def bench_import(args):
+    from qgis.core import QgsFeature, QgsGeometry, QgsPointXY, QgsVectorLayer
+    from carto.core.importlayertask import ImportLayerTask
+
+    layer = QgsVectorLayer(
+        "Point?crs=EPSG:4326&field=name:string&field=value:double", "import", "memory"
+    )
+    features = []
+    for i in range(args.rows):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([f"feature {i}", i / 2])
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(i % 360 - 180, i % 170 - 85)))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    task = ImportLayerTask(
+        CONNECTION_NAME, "postgres", f"{DATABASE}.{SCHEMA}.imported", layer
+    )
+    ok, seconds = _timed(args.url, task.run)
+    if not ok:
+        raise Exception(task.exception)
+    return args.rows, seconds
+
+
+def bench_upload(args):
+    from qgis.core import QgsProject
+    from carto.core import layers
+    from carto.core.layers import LayerTracker
+
+    layers.iface = _HeadlessInterface()
+    layer = _download(args.rows)
+    QgsProject.instance().addMapLayer(layer)
+    LayerTracker.instance().layer_added(layer)
+    layer.startEditing()
+    field = layer.fields().indexOf("name")
+    edited = 0
+    for feature in layer.getFeatures():
+        if edited == args.edits:
+            break
+        layer.changeAttributeValue(feature.id(), field, f"edited {feature.id()}")
+        edited += 1
+    # changes are uploaded when they are committed to the local layer
+    _, seconds = _timed(args.url, layer.commitChanges)
+    return edited, seconds
+
+
+def bench_tiles(args):
+    from qgis.core import QgsBlockingNetworkRequest, QgsNetworkAccessManager
+    from qgis.PyQt.QtCore import QUrl
+    from qgis.PyQt.QtNetwork import QNetworkRequest
+    from carto.core.api import CARTO_API
+
+    # as in the plugin, the token is added by the preprocessor and isn't
+    # part of the tile URLs
+    QgsNetworkAccessManager.setRequestPreprocessor(CARTO_API.add_auth_header)
+    table = _table()
+
+    def _fetch():
+        template = table.tileset()["tiles"][0]
+        n = 2 ** TILES_ZOOM
+        for x in range(n):
+            for y in range(n):
+                url = template.replace("{z}", str(TILES_ZOOM))
+                url = url.replace("{x}", str(x)).replace("{y}", str(y))
+                request = QgsBlockingNetworkRequest()
+                result = request.get(QNetworkRequest(QUrl(url)))
+                if result != QgsBlockingNetworkRequest.NoError:
+                    raise Exception(request.errorMessage())
+        return n * n
+
+    # the rows of this benchmark are the tiles fetched
+    return _timed(args.url, _fetch)
+
+
+def run_benchmark(args):
+    with tempfile.TemporaryDirectory() as profile:
+        app = _init_qgis(profile)
+        _configure_api(args.url)
+        if args.memory_budget:
+            from carto.core.utils import setSetting, MEMORY_BUDGET
+
+            setSetting(MEMORY_BUDGET, args.memory_budget)
+        rows, seconds = globals()[f"bench_{args.bench}"](args)
+        stats = _server_stats(args.url)
+        app.exitQgis()
+    # the peak memory of the upload benchmark includes the download of the
+    # layer that is edited
+    return {
+        "benchmark": args.bench,
+        "rows": rows,
+        "seconds": seconds,
+        "requests": stats["requests"],
+        "bytes_in": stats["bytes_in"],
+        "bytes_out": stats["bytes_out"],
+        "peak_rss": _peak_rss(),
+    }
+
+
+def _print_table(results):
+    columns = ["benchmark", "rows", "seconds", "rows/s", "requests"]
+    columns += ["MB sent", "MB received", "peak RSS MB"]
+    print("".join(c.ljust(14) for c in columns))
+    for r in results:
+        values = [
+            r["benchmark"],
+            r["rows"],
+            f"{r['seconds']:.2f}",
+            f"{r['rows'] / r['seconds']:.0f}" if r["seconds"] else "-",
+            r["requests"],
+            f"{r['bytes_in'] / 1024 ** 2:.2f}",
+            f"{r['bytes_out'] / 1024 ** 2:.2f}",
+            f"{r['peak_rss'] / 1024 ** 2:.0f}",
+        ]
+        print("".join(str(v).ljust(14) for v in values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--edits", type=int, default=1000, help="Features edited to upload")
+    parser.add_argument("--latency", type=float, default=0, help="Latency in ms")
+    parser.add_argument("--bandwidth", type=float, help="Bandwidth in bytes per second")
+    parser.add_argument("--max-rows", type=int, help="Maximum rows per query result")
+    parser.add_argument("--no-arrow", action="store_true", help="Only use JSON results")
+    parser.add_argument("--memory-budget", type=int, help="Memory budget in MB")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("benchmarks", nargs="*", help=f"One or more of {BENCHMARKS}")
+    # used internally to run a single benchmark in a child process
+    parser.add_argument("--bench", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.bench:
+        print(json.dumps(run_benchmark(args)))
+        return
+    for bench in args.benchmarks:
+        if bench not in BENCHMARKS:
+            parser.error(f"Unknown benchmark: {bench}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        db = os.path.join(folder, "mockcarto.sqlite")
+        create_sample_table(db, rows=args.rows)
+        server = MockCartoServer(
+            db,
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            max_rows=args.max_rows,
+            arrow=not args.no_arrow,
+        ).start()
+        try:
+            for bench in args.benchmarks or BENCHMARKS:
+                command = [sys.executable, __file__, "--bench", bench, "--url", server.url]
+                command += ["--rows", str(args.rows), "--edits", str(args.edits)]
+                if args.memory_budget:
+                    command += ["--memory-budget", str(args.memory_budget)]
+                output = subprocess.run(command, check=True, capture_output=True, text=True)
+                results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        finally:
+            server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_table(results)
+
+
+if __name__ == "__main__":
+    main()
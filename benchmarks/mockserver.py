@@ -0,0 +1,664 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the CARTO workspace and SQL APIs, backed by a SQLite
+database, to run the plugin against without a CARTO account.
+
+It serves a single connection with the postgres provider, so the SQL that
+the plugin sends is close enough to SQLite to be run directly. Geometries
+are stored as GeoJSON text, and the few spatial functions used by the
+plugin are registered as SQLite functions.
+
+Latency, bandwidth and the maximum number of rows per response can be set
+to simulate a remote warehouse. Request counts and transferred bytes are
+available at /_stats.
+
+If pyarrow is installed, query results are returned as Arrow streams to
+clients that accept them, with geometries as GeoArrow WKB, unless the
+server is started with --no-arrow.
+
+Tables can also be served as dynamic vector tilesets, like the Maps API
+does. Tiles are encoded as Mapbox Vector Tiles, and requests for them
+without an Authorization header are rejected.
+
+Usage:
+
+    python benchmarks/mockserver.py --rows 100000 --latency 100
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+ARROW_STREAM_TYPE = "application/vnd.apache.arrow.stream"
+MVT_TYPE = "application/vnd.mapbox-vector-tile"
+CONNECTION_NAME = "mock"
+DATABASE = "carto"
+SCHEMA = "public"
+
+_geometry_types = {
+    1: "Point",
+    2: "LineString",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+}
+
+
+def _geojson_from_wkb(wkb):
+    def read(offset):
+        little = wkb[offset] == 1
+        prefix = "<" if little else ">"
+        code = struct.unpack_from(prefix + "I", wkb, offset + 1)[0]
+        offset += 5
+        # EWKB flags and ISO codes for Z and M
+        base = code & 0x0FFFFFFF
+        has_z = bool(code & 0x80000000) or base // 1000 in [1, 3]
+        has_m = bool(code & 0x40000000) or base // 1000 in [2, 3]
+        if code & 0x20000000:
+            offset += 4
+        geom_type = _geometry_types[base % 1000]
+        dims = 2 + int(has_z) + int(has_m)
+
+        def points(offset):
+            n = struct.unpack_from(prefix + "I", wkb, offset)[0]
+            offset += 4
+            coords = []
+            for _ in range(n):
+                coords.append(list(struct.unpack_from(prefix + "d" * dims, wkb, offset))[:2])
+                offset += 8 * dims
+            return coords, offset
+
+        if geom_type == "Point":
+            coords = list(struct.unpack_from(prefix + "d" * dims, wkb, offset))[:2]
+            return {"type": geom_type, "coordinates": coords}, offset + 8 * dims
+        if geom_type == "LineString":
+            coords, offset = points(offset)
+            return {"type": geom_type, "coordinates": coords}, offset
+        n = struct.unpack_from(prefix + "I", wkb, offset)[0]
+        offset += 4
+        parts = []
+        for _ in range(n):
+            if geom_type == "Polygon":
+                part, offset = points(offset)
+            else:
+                part, offset = read(offset)
+                part = part["coordinates"]
+            parts.append(part)
+        return {"type": geom_type, "coordinates": parts}, offset
+
+    return read(0)[0]
+
+
+def _wkb_from_geojson(geojson):
+    codes = {name: code for code, name in _geometry_types.items()}
+
+    def points(coords):
+        return struct.pack("<I", len(coords)) + b"".join(
+            struct.pack("<dd", *c[:2]) for c in coords
+        )
+
+    def write(geom_type, coords):
+        header = struct.pack("<BI", 1, codes[geom_type])
+        if geom_type == "Point":
+            return header + struct.pack("<dd", *coords[:2])
+        if geom_type == "LineString":
+            return header + points(coords)
+        if geom_type == "Polygon":
+            return header + struct.pack("<I", len(coords)) + b"".join(map(points, coords))
+        part_type = geom_type[len("Multi") :]
+        return (
+            header
+            + struct.pack("<I", len(coords))
+            + b"".join(write(part_type, part) for part in coords)
+        )
+
+    return write(geojson["type"], geojson["coordinates"])
+
+
+def _arrow_stream(result):
+    types = {"boolean": pyarrow.bool_(), "bigint": pyarrow.int64(), "double": pyarrow.float64()}
+    fields, arrays = [], []
+    for column in result["schema"]:
+        name = column["name"]
+        values = [row[name] for row in result["rows"]]
+        if column["type"] == "geometry":
+            metadata = {"ARROW:extension:name": "geoarrow.wkb"}
+            fields.append(pyarrow.field(name, pyarrow.binary(), metadata=metadata))
+            values = [None if v is None else _wkb_from_geojson(v) for v in values]
+            arrays.append(pyarrow.array(values, pyarrow.binary()))
+        else:
+            data_type = types.get(column["type"], pyarrow.string())
+            fields.append(pyarrow.field(name, data_type))
+            if data_type == pyarrow.string():
+                values = [None if v is None else str(v) for v in values]
+            arrays.append(pyarrow.array(values, data_type))
+    table = pyarrow.Table.from_arrays(arrays, schema=pyarrow.schema(fields))
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+MVT_EXTENT = 4096
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _pb_field(number, wire_type, payload):
+    """
+    Encodes a protobuf field. payload is an int for varints and bytes for
+    length-delimited fields
+    """
+    key = _varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + _varint(payload)
+    if wire_type == 1:
+        return key + payload
+    return key + _varint(len(payload)) + payload
+
+
+def _mvt_geometry(geojson, project):
+    """
+    Returns the MVT geometry type and commands of a GeoJSON geometry, with
+    coordinates projected to tile coordinates by the project function
+    """
+    commands = []
+    cursor = [0, 0]
+
+    def move(points, command):
+        commands.append(command | (len(points) << 3))
+        for x, y in points:
+            commands.extend([_zigzag(x - cursor[0]), _zigzag(y - cursor[1])])
+            cursor[:] = [x, y]
+
+    def line(coords):
+        points = [project(c) for c in coords]
+        move(points[:1], 1)
+        move(points[1:], 2)
+
+    def ring(coords, exterior):
+        points = [project(c) for c in coords[:-1]]
+        # exterior rings have a positive area in tile coordinates, where y
+        # grows downwards, and interior rings a negative one
+        area = sum(
+            x0 * y1 - x1 * y0
+            for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1])
+        )
+        if (area > 0) != exterior:
+            points.reverse()
+        move(points[:1], 1)
+        move(points[1:], 2)
+        commands.append(7 | (1 << 3))
+
+    geom_type = geojson["type"]
+    coords = geojson["coordinates"]
+    if geom_type in ["Point", "MultiPoint"]:
+        move([project(c) for c in ([coords] if geom_type == "Point" else coords)], 1)
+        return 1, commands
+    if geom_type in ["LineString", "MultiLineString"]:
+        for part in [coords] if geom_type == "LineString" else coords:
+            line(part)
+        return 2, commands
+    for polygon in [coords] if geom_type == "Polygon" else coords:
+        for i, part in enumerate(polygon):
+            ring(part, i == 0)
+    return 3, commands
+
+
+def _mvt_tile(name, features, z, x, y):
+    """
+    Encodes (properties, GeoJSON geometry) pairs in lon/lat as a single
+    layer vector tile. Features are only clipped by their bounding box
+    """
+    n = 2 ** z
+
+    def project(coords):
+        lon, lat = coords[0], max(-85.0511, min(85.0511, coords[1]))
+        px = (lon + 180) / 360 * n
+        py = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+        return round((px - x) * MVT_EXTENT), round((py - y) * MVT_EXTENT)
+
+    def bounds(coords):
+        if isinstance(coords[0], (int, float)):
+            return project(coords) * 2
+        boxes = [bounds(c) for c in coords]
+        return (
+            min(b[0] for b in boxes),
+            min(b[1] for b in boxes),
+            max(b[2] for b in boxes),
+            max(b[3] for b in boxes),
+        )
+
+    keys, values, encoded = {}, {}, b""
+    for fid, (properties, geojson) in enumerate(features):
+        xmin, ymin, xmax, ymax = bounds(geojson["coordinates"])
+        if xmax < 0 or ymax < 0 or xmin > MVT_EXTENT or ymin > MVT_EXTENT:
+            continue
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value_field = _pb_field(7, 0, int(value))
+            elif isinstance(value, int):
+                value_field = _pb_field(6, 0, _zigzag(value))
+            elif isinstance(value, float):
+                value_field = _pb_field(3, 1, struct.pack("<d", value))
+            else:
+                value_field = _pb_field(1, 2, str(value).encode())
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(value_field, len(values)))
+        geom_type, commands = _mvt_geometry(geojson, project)
+        encoded += _pb_field(
+            2,
+            2,
+            _pb_field(1, 0, fid + 1)
+            + _pb_field(2, 2, b"".join(map(_varint, tags)))
+            + _pb_field(3, 0, geom_type)
+            + _pb_field(4, 2, b"".join(map(_varint, commands))),
+        )
+    layer = _pb_field(15, 0, 2) + _pb_field(1, 2, name.encode()) + encoded
+    layer += b"".join(_pb_field(3, 2, key.encode()) for key in keys)
+    layer += b"".join(_pb_field(4, 2, value) for value in values)
+    layer += _pb_field(5, 0, MVT_EXTENT)
+    return _pb_field(3, 2, layer)
+
+
+def _register_functions(connection):
+    def geometry_type(value):
+        if value is None:
+            return None
+        return json.loads(value)["type"].upper()
+
+    def geom_from_wkb(value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = bytes.fromhex(value)
+        return json.dumps(_geojson_from_wkb(value))
+
+    connection.create_function("GEOMETRYTYPE", 1, geometry_type)
+    connection.create_function("ST_SRID", 1, lambda value: 4326)
+    # all the geometries are in EPSG:4326 already
+    connection.create_function("ST_TRANSFORM", 2, lambda value, srid: value)
+    connection.create_function("ST_SETSRID", 2, lambda value, srid: value)
+    connection.create_function("ST_GEOMFROMWKB", 1, geom_from_wkb)
+    connection.create_function("DECODE", 2, lambda value, encoding: value)
+    connection.create_function("HAS_SCHEMA_PRIVILEGE", -1, lambda *args: True)
+
+
+def create_sample_table(path, name="points", rows=10000, seed=0):
+    """
+    Creates a table of random points with a few attributes of each type
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+        connection.execute(
+            f"""CREATE TABLE "{name}" (
+                id BIGINT PRIMARY KEY,
+                name TEXT,
+                value DOUBLE PRECISION,
+                flag BOOLEAN,
+                created DATE,
+                geom GEOMETRY
+            )"""
+        )
+        connection.executemany(
+            f'INSERT INTO "{name}" VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                (
+                    i,
+                    f"feature {i}",
+                    rng.uniform(0, 1000),
+                    rng.random() > 0.5,
+                    f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                    json.dumps(
+                        {
+                            "type": "Point",
+                            "coordinates": [rng.uniform(-180, 180), rng.uniform(-85, 85)],
+                        }
+                    ),
+                )
+                for i in range(rows)
+            ),
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+class MockCartoServer:
+    def __init__(
+        self,
+        path,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        bandwidth=None,
+        max_rows=None,
+        arrow=True,
+    ):
+        """
+        latency is in milliseconds per request, bandwidth in bytes per second
+        (None for unlimited), and max_rows the maximum number of rows of a
+        query result. Larger results fail, like they do in the SQL API.
+        arrow enables Arrow results, if pyarrow is installed
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_rows = max_rows
+        self.arrow = arrow and pyarrow is not None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        _register_functions(self._db)
+        self._fqn = re.compile(rf'"?{DATABASE}"?\."?{SCHEMA}"?\.')
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    @property
+    def workspace_url(self):
+        return self.url + "workspace/"
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "queries": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._db.close()
+
+    def _tables(self):
+        return [
+            row[0]
+            for row in self._db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%' ORDER BY name"
+            )
+        ]
+
+    def _columns(self, table):
+        return self._db.execute(f'PRAGMA table_info("{table}")').fetchall()
+
+    def resources(self, path):
+        with self._lock:
+            parts = path.split(".") if path else []
+            if len(parts) == 0:
+                return {"children": [{"id": DATABASE, "name": DATABASE}]}
+            elif len(parts) == 1:
+                return {"children": [{"id": f"{DATABASE}.{SCHEMA}", "name": SCHEMA}]}
+            elif len(parts) == 2:
+                return {
+                    "children": [
+                        {"id": f"{path}.{table}", "name": table, "type": "table"}
+                        for table in self._tables()
+                    ]
+                }
+            columns = self._columns(parts[-1])
+            return {
+                "schema": [{"name": c[1], "type": c[2].lower()} for c in columns],
+                "geomField": next((c[1] for c in columns if c[2].upper() == "GEOMETRY"), None),
+            }
+
+    def query(self, sql):
+        sql = self._fqn.sub("", sql)
+        block = re.search(r"DO \$\$\s*BEGIN(.*)END;\s*\$\$;", sql, re.S)
+        if block is not None:
+            sql = block.group(1)
+        if "pg_index" in sql:
+            return self._primary_keys()
+        statement = "\n".join(
+            line for line in sql.splitlines() if not line.strip().startswith("--")
+        ).strip()
+        with self._lock:
+            self.stats["queries"] += 1
+            if not re.match(r"(SELECT|WITH)\b", statement, re.I):
+                self._db.executescript(statement)
+                return {"rows": [], "schema": []}
+            cursor = self._db.execute(statement.rstrip(";"))
+            names = [d[0] for d in cursor.description]
+            values = cursor.fetchall()
+        if self.max_rows is not None and len(values) > self.max_rows:
+            raise ValueError(f"Result exceeds the maximum of {self.max_rows} rows")
+        rows = []
+        for row in values:
+            rows.append(
+                {
+                    name: json.loads(value)
+                    if isinstance(value, str) and value.startswith('{"type"')
+                    else value
+                    for name, value in zip(names, row)
+                }
+            )
+        return {"rows": rows, "schema": self._schema(names, rows)}
+
+    def _primary_keys(self):
+        with self._lock:
+            rows = [
+                {"table_name": table, "column_name": c[1]}
+                for table in self._tables()
+                for c in self._columns(table)
+                if c[5]
+            ]
+        return {"rows": rows, "schema": []}
+
+    @staticmethod
+    def _schema(names, rows):
+        schema = []
+        for name in names:
+            value = next((row[name] for row in rows if row[name] is not None), None)
+            if isinstance(value, dict):
+                data_type = "geometry"
+            elif isinstance(value, bool):
+                data_type = "boolean"
+            elif isinstance(value, int):
+                data_type = "bigint"
+            elif isinstance(value, float):
+                data_type = "double"
+            else:
+                data_type = "string"
+            schema.append({"name": name, "type": data_type})
+        return schema
+
+    def tileset(self, connection, params):
+        """
+        Returns the response of instantiating a tileset of a table, which
+        points to its TileJSON
+        """
+        url = f"{self.url}v3/maps/{connection}/table/tilejson?{urlencode(params)}"
+        return {"tilejson": {"url": [url]}}
+
+    def tilejson(self, connection, params):
+        url = f"{self.url}v3/maps/{connection}/table/{{z}}/{{x}}/{{y}}"
+        table = params["name"].split(".")[-1]
+        return {
+            "tilejson": "3.0.0",
+            "tiles": [f"{url}?{urlencode(params)}"],
+            "minzoom": 0,
+            "maxzoom": 14,
+            "vector_layers": [{"id": table, "fields": {}}],
+        }
+
+    def tile(self, params, z, x, y):
+        table = params["name"].split(".")[-1]
+        geo_column = params["geo_column"]
+        columns = params["columns"].split(",") if params.get("columns") else None
+        with self._lock:
+            cursor = self._db.execute(f'SELECT * FROM "{table}"')
+            names = [d[0] for d in cursor.description]
+            values = cursor.fetchall()
+        features = []
+        for row in values:
+            row = dict(zip(names, row))
+            geom = row.pop(geo_column)
+            if geom is None:
+                continue
+            if columns is not None:
+                row = {k: v for k, v in row.items() if k in columns}
+            features.append((row, json.loads(geom)))
+        return _mvt_tile(table, features, z, x, y)
+
+    def _config(self):
+        return (
+            "apis:\n"
+            f"  workspaceUrl: {self.workspace_url}\n"
+            f"  baseUrl: {self.url}\n"
+            "cartoVersion:\n"
+            "  selfHosted: ''\n"
+        )
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _params(self):
+                params = parse_qs(urlparse(self.path).query)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                server.stats["bytes_in"] += len(self.path) + len(body)
+                if body:
+                    params.update(parse_qs(body.decode()))
+                return {k: v[0] for k, v in params.items()}
+
+            def _send(self, status, body, content_type="application/json"):
+                if not isinstance(body, bytes):
+                    body = body.encode()
+                if server.bandwidth:
+                    time.sleep(len(body) / server.bandwidth)
+                server.stats["bytes_out"] += len(body)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                path = urlparse(self.path).path
+                params = self._params()
+                if path == "/_stats":
+                    return self._send(200, json.dumps(server.stats))
+                if path == "/_reset":
+                    server.reset_stats()
+                    return self._send(200, "{}")
+                server.stats["requests"] += 1
+                time.sleep(server.latency / 1000)
+                try:
+                    if path == "/config.yaml":
+                        return self._send(200, server._config(), "text/yaml")
+                    if path == "/workspace/connections":
+                        connection = {
+                            "id": CONNECTION_NAME,
+                            "name": CONNECTION_NAME,
+                            "provider_id": "postgres",
+                        }
+                        return self._send(200, json.dumps([connection]))
+                    match = re.match(r"/workspace/connections/[^/]+/resources/?(.*)", path)
+                    if match is not None:
+                        return self._send(200, json.dumps(server.resources(match.group(1))))
+                    match = re.match(r"/v3/maps/([^/]+)/table(/.*)?$", path)
+                    if match is not None:
+                        connection, rest = match.group(1), match.group(2) or ""
+                        params.pop("client", None)
+                        if not rest:
+                            result = server.tileset(connection, params)
+                            return self._send(200, json.dumps(result))
+                        if rest == "/tilejson":
+                            result = server.tilejson(connection, params)
+                            return self._send(200, json.dumps(result))
+                        authorization = self.headers.get("Authorization") or ""
+                        if not authorization.startswith("Bearer "):
+                            return self._send(401, json.dumps({"error": "Unauthorized"}))
+                        z, x, y = map(int, rest.strip("/").split("/"))
+                        tile = server.tile(params, z, x, y)
+                        return self._send(200, tile, MVT_TYPE)
+                    if re.match(r"/v3/sql/[^/]+/query", path):
+                        result = server.query(params["q"])
+                        accept = self.headers.get("Accept") or ""
+                        if server.arrow and ARROW_STREAM_TYPE in accept:
+                            return self._send(
+                                200, _arrow_stream(result), ARROW_STREAM_TYPE
+                            )
+                        return self._send(200, json.dumps(result, default=str))
+                    self._send(404, json.dumps({"error": "Not found"}))
+                except Exception as e:
+                    self._send(400, json.dumps({"error": str(e)}))
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", default="mockcarto.sqlite", help="SQLite database file")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rows", type=int, help="(Re)create a sample table with N rows")
+    parser.add_argument("--latency", type=float, default=0, help="Latency in ms")
+    parser.add_argument("--bandwidth", type=float, help="Bandwidth in bytes per second")
+    parser.add_argument("--max-rows", type=int, help="Maximum rows per query result")
+    parser.add_argument("--no-arrow", action="store_true", help="Only return JSON results")
+    args = parser.parse_args()
+    if args.rows is not None:
+        create_sample_table(args.db, rows=args.rows)
+    server = MockCartoServer(
+        args.db,
+        port=args.port,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        max_rows=args.max_rows,
+        arrow=not args.no_arrow,
+    )
+    print(f"Serving the CARTO API for {args.db} at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
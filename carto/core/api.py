@@ -3,21 +3,43 @@ try:
 except ImportError:
     from urlparse import urljoin
 import requests
+import time
 import uuid
-from qgis.PyQt.QtCore import QObject, QSettings
+from qgis.PyQt.QtCore import QObject, QSettings, QUrl
 from qgis.utils import iface
-from qgis.core import Qgis, QgsMessageLog, QgsAuthMethodConfig, QgsApplication
+from qgis.core import (
+    Qgis,
+    QgsMessageLog,
+    QgsAuthMethodConfig,
+    QgsApplication,
+    QgsNetworkAccessManager,
+)
 from carto.core.utils import (
     setting,
     TOKEN,
     set_proxy_values,
 )
+from carto.core.metrics import REQUEST_LOG
+from carto.core.features import schema_from_arrow
+from carto.core.jsonstream import RowStream, CHUNK_SIZE
 
 import os
 import yaml
 
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+ARROW_STREAM_TYPE = "application/vnd.apache.arrow.stream"
+
 USER_URL = "https://accounts.app.carto.com/users/me"
 
+# request preprocessors, which add the token to the requests of vector tile
+# layers, are only available since QGIS 3.22
+HAS_REQUEST_PREPROCESSOR = hasattr(QgsNetworkAccessManager, "setRequestPreprocessor")
+
 
 class CartoApi(QObject):
 
@@ -25,6 +47,7 @@ class CartoApi(QObject):
     workspace_url = None
     base_url = None
     roles = []
+    user_email = None
     is_self_hosted = False
 
     def __init__(self):
@@ -38,6 +61,7 @@ class CartoApi(QObject):
     def configure_endpoints(self):
         user = self.user().json()
         self.roles = user["app_metadata"]["roles"]
+        self.user_email = user.get("email")
         tenant = user["user_metadata"]["tenant_domain"]
         urls_url = f"https://{tenant}/config.yaml"
         response = self.get(urls_url, verify=False)
@@ -52,6 +76,7 @@ class CartoApi(QObject):
     def clear(self):
         self.token = None
         self.roles = []
+        self.user_email = None
         self.workspace_url = None
         self.base_url = None
 
@@ -70,6 +95,13 @@ class CartoApi(QObject):
         return self.token is not None
 
     def get(self, endpoint, params=None, verify=True):
+        start = time.perf_counter()
+        response = self._get(endpoint, params, verify)
+        REQUEST_LOG.record(response, start)
+        return response
+
+    def _get(self, endpoint, params=None, verify=True, headers=None, stream=False):
+        headers = dict(headers or {}, Authorization=f"Bearer {self.token}")
         _params = {}
         if params:
             _params = {k: v for k, v in params.items() if v is not None}
@@ -81,18 +113,22 @@ class CartoApi(QObject):
                 requests.packages.urllib3.disable_warnings(
                     requests.packages.urllib3.exceptions.InsecureRequestWarning
                 )
+                with REQUEST_LOG.request(url):
+                    response = self.session.get(
+                        url,
+                        headers=headers,
+                        params=_params,
+                        verify=False,
+                        stream=stream,
+                    )
+        else:
+            with REQUEST_LOG.request(url):
                 response = self.session.get(
                     url,
-                    headers={"Authorization": f"Bearer {self.token}"},
+                    headers=headers,
                     params=_params,
-                    verify=False,
+                    stream=stream,
                 )
-        else:
-            response = self.session.get(
-                url,
-                headers={"Authorization": f"Bearer {self.token}"},
-                params=_params,
-            )
         return response
 
     def get_json(self, endpoint, params=None):
@@ -100,30 +136,104 @@ class CartoApi(QObject):
         response.raise_for_status()
         return response.json()
 
-    def execute_query(self, connectionname, query):
+    def execute_query(self, connectionname, query, columnar=False, stream=False):
+        """
+        Runs a query and returns its rows and schema. If columnar is True and
+        the API can return the result as an Arrow stream, the result has an
+        Arrow table instead of rows. If stream is True, JSON results are
+        parsed while they are downloaded: their rows are a RowStream, and
+        the schema has to be read from it
+        """
         url = urljoin(self.base_url, f"v3/sql/{connectionname}/query")
         query = f"""
         -- {uuid.uuid4()}
         {query}
         """
-        response = self.get(
+        headers = None
+        if columnar and pyarrow is not None:
+            headers = {"Accept": f"{ARROW_STREAM_TYPE}, application/json;q=0.9"}
+        start = time.perf_counter()
+        response = self._get(
             url,
             params={"q": query},
+            headers=headers,
+            stream=stream,
         )
-        response.raise_for_status()
-        _json = response.json()
-        return _json
+        return self._query_result(response, start, query, stream)
 
     def execute_query_post(self, connectionname, query):
         url = urljoin(self.base_url, f"v3/sql/{connectionname}/query")
-        response = self.session.post(
-            url,
-            headers={"Authorization": f"Bearer {self.token}"},
-            data={"q": query},
+        start = time.perf_counter()
+        with REQUEST_LOG.request(url):
+            response = self.session.post(
+                url,
+                headers={"Authorization": f"Bearer {self.token}"},
+                data={"q": query},
+            )
+        return self._query_result(response, start, query)
+
+    def _query_result(self, response, start, query, stream=False):
+        if not response.ok:
+            REQUEST_LOG.record(response, start, query)
+            response.raise_for_status()
+        arrow = response.headers.get("Content-Type", "").startswith(ARROW_STREAM_TYPE)
+        if stream and not arrow:
+
+            def _finished(rows):
+                response.close()
+                REQUEST_LOG.record(
+                    response,
+                    start,
+                    query,
+                    parse_time=rows.parse_time,
+                    bytes_in=rows.bytes_read,
+                )
+
+            rows = RowStream(response.iter_content(CHUNK_SIZE), on_close=_finished)
+            return {"rows": rows}
+        parse_start = time.perf_counter()
+        if arrow:
+            table = pyarrow.ipc.open_stream(response.content).read_all()
+            result = {"table": table, "schema": schema_from_arrow(table.schema)}
+        else:
+            result = response.json()
+        REQUEST_LOG.record(
+            response, start, query, parse_time=time.perf_counter() - parse_start
         )
+        return result
+
+    def table_tileset(self, connectionname, fqn, geo_column, columns=None):
+        """
+        Instantiates a dynamic tileset of a table in the Maps API, and returns
+        its TileJSON. The Maps API doesn't return the TileJSON itself, but the
+        URL where it can be fetched
+        """
+        url = urljoin(self.base_url, f"v3/maps/{connectionname}/table")
+        params = {"name": fqn, "geo_column": geo_column, "formatTiles": "mvt"}
+        if columns:
+            params["columns"] = ",".join(columns)
+        response = self.get(url, params=params)
+        response.raise_for_status()
+        tilejson_url = response.json()["tilejson"]["url"]
+        if isinstance(tilejson_url, list):
+            tilejson_url = tilejson_url[0]
+        response = self.get(tilejson_url)
         response.raise_for_status()
-        _json = response.json()
-        return _json
+        return response.json()
+
+    def add_auth_header(self, request):
+        """
+        Request preprocessor for the QGIS network access manager. Adds the
+        token of the session to the requests that QGIS makes to the CARTO
+        APIs, like the ones for the tiles of vector tile layers, so the token
+        isn't stored in the layer source
+        """
+        if self.token is None or self.base_url is None:
+            return
+        if request.hasRawHeader(b"Authorization"):
+            return
+        if request.url().host() == QUrl(self.base_url).host():
+            request.setRawHeader(b"Authorization", f"Bearer {self.token}".encode())
 
     def connections(self):
         try:
@@ -0,0 +1,124 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from qgis.core import QgsTask
+from qgis.PyQt.QtCore import pyqtSignal
+
+from carto.core.api import CARTO_API
+from carto.core.downloadtabletask import DownloadTableTask
+from carto.core.logging import error
+from carto.core.memory import max_workers
+from carto.core.metrics import log_task_requests, REQUEST_LOG
+from carto.core.scheduler import (
+    MAX_TASKS_PER_CONNECTION,
+    RESERVED_TASKS_PER_CONNECTION,
+)
+from carto.core.utils import quote_for_provider, MAX_ROWS
+
+# the downloads of a batch share the slots that bulk tasks can use for a
+# connection, as the batch runs as a single task in the scheduler
+MAX_BATCH_DOWNLOADS = MAX_TASKS_PER_CONNECTION - RESERVED_TASKS_PER_CONNECTION
+
+
+class BatchDownloadTask(QgsTask):
+    """
+    Downloads several tables of a schema. The metadata that the downloads
+    need is fetched for all the tables together before they start: primary
+    keys and write permissions once for the schema, row counts with a
+    single query, and table info concurrently. The downloads then run in a
+    bounded pool
+    """
+
+    # emitted with the table name and its download progress
+    table_progress_changed = pyqtSignal(str, float)
+
+    def __init__(self, schema, tables, limit=MAX_ROWS):
+        super().__init__(
+            f"Download {len(tables)} tables from {schema.name}", QgsTask.CanCancel
+        )
+        self.exception = None
+        self.schema = schema
+        self.tables = tables
+        self.limit = limit
+        self.tasks = []
+        self.layers = []
+        self.failed = []
+
+    @log_task_requests
+    def run(self):
+        executor = ThreadPoolExecutor(
+            max_workers=max_workers(MAX_BATCH_DOWNLOADS),
+            thread_name_prefix="carto-batch",
+        )
+        try:
+            futures = [
+                executor.submit(REQUEST_LOG.bind(self.schema.primary_keys)),
+                executor.submit(REQUEST_LOG.bind(self.schema.can_write)),
+            ]
+            futures += [
+                executor.submit(REQUEST_LOG.bind(table.table_info))
+                for table in self.tables
+            ]
+            row_counts = self.row_counts()
+            for future in futures:
+                future.result()
+            self.setProgress(5)
+
+            self.tasks = [
+                DownloadTableTask(
+                    table, "TRUE", self.limit, row_count=row_counts[table.tableid]
+                )
+                for table in self.tables
+                if row_counts[table.tableid]
+            ]
+            weights = [min(self.limit, task._row_count) for task in self.tasks]
+            futures = {executor.submit(task.run): task for task in self.tasks}
+            pending = set(futures)
+            reported = {}
+            while pending:
+                _, pending = wait(pending, timeout=0.5)
+                if self.isCanceled():
+                    for task in self.tasks:
+                        task.cancel()
+                for task in self.tasks:
+                    if reported.get(task) != task.progress():
+                        reported[task] = task.progress()
+                        self.table_progress_changed.emit(
+                            task.table.name, task.progress()
+                        )
+                done = sum(w * t.progress() for w, t in zip(weights, self.tasks))
+                self.setProgress(5 + 95 * done / max(1, sum(weights)))
+
+            for future, task in futures.items():
+                if future.result() and task.layer is not None:
+                    self.layers.append(task.layer)
+                elif task.exception is not None:
+                    self.failed.append(task.table.name)
+            return not self.isCanceled()
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+        finally:
+            executor.shutdown(wait=False)
+
+    def row_counts(self):
+        """
+        Returns the number of rows of each table, counted with a single query
+        """
+        provider_type = self.schema.database.connection.provider_type
+        counts = []
+        for table in self.tables:
+            fqn = quote_for_provider(
+                f"{self.schema.database.databaseid}.{self.schema.schemaid}.{table.tableid}",
+                provider_type,
+            )
+            tableid = table.tableid.replace("'", "''")
+            counts.append(
+                f"SELECT '{tableid}' AS table_id, COUNT(*) AS row_count FROM {fqn}"
+            )
+        ret = CARTO_API.execute_query(
+            self.schema.database.connection.name, "\nUNION ALL\n".join(counts) + ";"
+        )
+        rows = [{k.lower(): v for k, v in row.items()} for row in ret["rows"]]
+        return {row["table_id"]: int(row["row_count"]) for row in rows}
@@ -0,0 +1,78 @@
+import traceback
+
+from qgis.core import QgsTask
+from qgis.PyQt.QtCore import QObject
+
+from carto.core.enums import TaskPriority
+from carto.core.logging import error
+from carto.core.scheduler import TASK_SCHEDULER
+
+
+class LoadCatalogTask(QgsTask):
+    def __init__(self, description, fetch):
+        super().__init__(description, QgsTask.CanCancel)
+        self.exception = None
+        self.fetch = fetch
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = self.fetch()
+            return not self.isCanceled()
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+
+
+class CatalogLoader(QObject):
+    """
+    Runs catalog requests (databases, schemas, tables) on worker threads,
+    so that expanding a browser node doesn't block the GUI
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._tasks = {}
+        self._generation = 0
+
+    def load(self, key, connection_name, description, fetch, callback):
+        """
+        Starts loading a catalog level in the background, unless a load for
+        the same key is already running. The callback is called in the main
+        thread with the loaded value, or with None if loading failed.
+        Results of loads that were canceled or went stale in the meantime
+        are discarded.
+        """
+        if key in self._tasks:
+            return
+        task = LoadCatalogTask(description, fetch)
+        generation = self._generation
+
+        def _finished(successful):
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+            if task.isCanceled() or generation != self._generation:
+                return
+            callback(task.result if successful else None)
+
+        task.taskCompleted.connect(lambda: _finished(True))
+        task.taskTerminated.connect(lambda: _finished(False))
+        self._tasks[key] = task
+        TASK_SCHEDULER.add_task(task, connection_name, TaskPriority.Metadata)
+
+    def is_loading(self, key):
+        return key in self._tasks
+
+    def cancel(self, key):
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def cancel_all(self):
+        self._generation += 1
+        for key in list(self._tasks.keys()):
+            self.cancel(key)
+
+
+CATALOG_LOADER = CatalogLoader()
@@ -1,8 +1,23 @@
+import hashlib
+import json
+import threading
+
 from carto.core.api import CARTO_API
 from carto.core.layers import filepath_for_table
-from carto.core.utils import quote_for_provider
+from carto.core.utils import (
+    quote_for_provider,
+    quote_column_name_for_provider,
+    simplify_geometry_for_provider,
+    geometry_4326_for_provider,
+    PROVIDERS_WITH_SRID,
+)
 from carto.gui.utils import waitcursor
 from carto.core.importlayertask import ImportLayerTask
+from carto.core.catalogloader import CATALOG_LOADER
+from carto.core.scheduler import TASK_SCHEDULER
+from carto.core.prefetcher import CATALOG_PREFETCHER
+from carto.core.metrics import CACHE_STATS
+from carto.core.permissions import WRITE_PERMISSIONS
 from carto.gui.authorization_manager import AUTHORIZATION_MANAGER
 from carto.core.enums import AuthState
 
@@ -10,7 +25,6 @@ from qgis.core import (
     QgsVectorLayer,
     QgsMapLayer,
     Qgis,
-    QgsApplication,
 )
 from qgis.PyQt.QtCore import QObject, pyqtSignal, QCoreApplication
 
@@ -49,6 +63,8 @@ class CartoConnection(QObject):
 
     def _auth_status_changed(self, auth_status):
         try:
+            CATALOG_LOADER.cancel_all()
+            CATALOG_PREFETCHER.cancel_all()
             self.clear_connections_cache()
             self.connections_changed.emit()
         except Exception as e:
@@ -65,17 +81,25 @@ class ProviderConnection:
         self.name = name
         self.connectionid = connectionid
         self._databases = None
+        self._lock = threading.Lock()
 
     @waitcursor
     def databases(self):
-        if self._databases is None:
-            databases = CARTO_API.databases(self.connectionid)
-            self._databases = [
-                Database(database["id"], database["name"].replace("`", ""), self)
-                for database in databases
-            ]
+        # the lock makes a browser expansion wait for a prefetch of the same
+        # level that is already running, instead of requesting it again
+        with self._lock:
+            CACHE_STATS.count("catalog", self._databases is not None)
+            if self._databases is None:
+                databases = CARTO_API.databases(self.connectionid)
+                self._databases = [
+                    Database(database["id"], database["name"].replace("`", ""), self)
+                    for database in databases
+                ]
         return self._databases
 
+    def databases_loaded(self):
+        return self._databases is not None
+
 
 class Database:
 
@@ -84,16 +108,24 @@ class Database:
         self.name = name
         self.connection = connection
         self._schemas = None
+        self._lock = threading.Lock()
 
     @waitcursor
     def schemas(self):
-        if self._schemas is None:
-            schemas = CARTO_API.schemas(self.connection.connectionid, self.databaseid)
-            self._schemas = [
-                Schema(schema["id"], schema["name"], self) for schema in schemas
-            ]
+        with self._lock:
+            CACHE_STATS.count("catalog", self._schemas is not None)
+            if self._schemas is None:
+                schemas = CARTO_API.schemas(
+                    self.connection.connectionid, self.databaseid
+                )
+                self._schemas = [
+                    Schema(schema["id"], schema["name"], self) for schema in schemas
+                ]
         return self._schemas
 
+    def schemas_loaded(self):
+        return self._schemas is not None
+
 
 class Schema:
 
@@ -103,10 +135,18 @@ class Schema:
         self.name = name
         self._tables = None
         self._can_write = None
+        self._pks = None
         self.tasks = []
+        self._lock = threading.Lock()
+        self._pks_lock = threading.Lock()
 
     @waitcursor
     def tables(self):
+        with self._lock:
+            return self._load_tables()
+
+    def _load_tables(self):
+        CACHE_STATS.count("catalog", self._tables is not None)
         if self._tables is None:
             if self.database.connection.provider_type == "bigquery":
                 MAXNROWS = 50000000
@@ -179,24 +219,95 @@ class Schema:
 
         return self._tables
 
+    def tables_loaded(self):
+        return self._tables is not None
+
+    @waitcursor
+    def primary_keys(self):
+        """
+        Returns a dict with the primary key column of each table in the schema
+        that has one. All keys are fetched with a single query and cached
+        """
+        with self._pks_lock:
+            CACHE_STATS.count("primary keys", self._pks is not None)
+            if self._pks is None:
+                sql = self._primary_keys_query()
+                # only cached once the query succeeds, so a failed query is
+                # run again next time
+                pks = {}
+                if sql is not None:
+                    ret = CARTO_API.execute_query(self.database.connection.name, sql)
+                    for row in ret["rows"]:
+                        row = {k.lower(): v for k, v in row.items()}
+                        pks.setdefault(row["table_name"], row["column_name"])
+                self._pks = pks
+        return self._pks
+
+    def _primary_keys_query(self):
+        provider_type = self.database.connection.provider_type
+        if provider_type == "bigquery":
+            return f"""
+                    SELECT
+                        table_name, column_name
+                    FROM
+                        `{self.database.databaseid}.{self.schemaid}.INFORMATION_SCHEMA.KEY_COLUMN_USAGE`
+                    ORDER BY
+                        table_name, ordinal_position;
+                    """
+        elif provider_type == "postgres":
+            return f"""
+                    SELECT
+                        c.relname AS table_name,
+                        a.attname AS column_name
+                    FROM
+                        pg_index i
+                    JOIN
+                        pg_class c ON c.oid = i.indrelid
+                    JOIN
+                        pg_namespace n ON n.oid = c.relnamespace
+                    JOIN
+                        pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+                    WHERE
+                        n.nspname = '{self.schemaid}'
+                    AND
+                        i.indisprimary
+                    ORDER BY
+                        c.relname, a.attnum;
+                    """
+        elif provider_type == "redshift":
+            return f"""
+                    SELECT
+                        table_name, column_name
+                    FROM
+                        information_schema.key_column_usage
+                    WHERE
+                        table_schema = '{self.schemaid}'
+                    AND
+                        constraint_name = 'PRIMARY'
+                    ORDER BY
+                        table_name, ordinal_position;
+                    """
+        elif provider_type == "snowflake":
+            return f"""
+                    SELECT
+                        table_name, constraint_name AS column_name
+                    FROM
+                        {self.database.databaseid}.information_schema.table_constraints
+                    WHERE
+                        constraint_type = 'PRIMARY KEY'
+                    AND
+                        table_schema = '{self.schemaid}';
+                    """
+        return None
+
     @waitcursor
     def can_write(self):
         if self._can_write is None:
-            fqn = quote_for_provider(
-                f"{self.database.databaseid}.{self.schemaid}.__qgis_test_table",
-                self.database.connection.provider_type,
-            )
-            sql = [
-                f"DROP TABLE IF EXISTS {fqn};",
-                f"CREATE TABLE {fqn} AS (SELECT 1 AS id);",
-                f"DROP TABLE {fqn};",
-            ]
-            try:
-                for statement in sql:
-                    CARTO_API.execute_query(self.database.connection.name, statement)
-                self._can_write = True
-            except Exception as e:
-                self._can_write = False
+            can_write = WRITE_PERMISSIONS.can_write(self)
+            if can_write is None:
+                # unknown for now, so it's checked again next time
+                return False
+            self._can_write = can_write
         return self._can_write
 
     @waitcursor
@@ -232,17 +343,20 @@ class Schema:
 
         self.tasks.append(task)
 
-        QgsApplication.taskManager().addTask(task)
+        started = TASK_SCHEDULER.add_task(task, self.database.connection.name)
         QCoreApplication.processEvents()
         iface.messageBar().pushMessage(
             "",
-            "Import task added to QGIS task manager",
+            "Import task added to QGIS task manager"
+            if started
+            else "Import task queued, it will start when other tasks finish",
             level=Qgis.Info,
             duration=5,
         )
 
     def clear_tables_cache(self):
         self._tables = None
+        self._pks = None
 
 
 class Table:
@@ -256,6 +370,7 @@ class Table:
 
     @waitcursor
     def table_info(self):
+        CACHE_STATS.count("table info", self._table_info is not None)
         if self._table_info is None:
             self._table_info = CARTO_API.table_info(
                 self.schema.database.connection.connectionid,
@@ -271,70 +386,79 @@ class Table:
     def geom_column(self):
         return self.table_info()["geomField"]
 
+    def schema_version(self):
+        columns = json.dumps(self.columns(), sort_keys=True)
+        return hashlib.md5(columns.encode()).hexdigest()
+
     @waitcursor
     def pk(self):
-        if self.schema.database.connection.provider_type == "bigquery":
-            sql = f"""
-                    SELECT
-                        column_name
-                    FROM
-                        `{self.schema.database.databaseid}.{self.schema.schemaid}.INFORMATION_SCHEMA.KEY_COLUMN_USAGE`
-                    WHERE
-                        table_name = '{self.tableid}';
-                    """
-        elif self.schema.database.connection.provider_type == "postgres":
-            sql = f"""
-                    SELECT
-                        a.attname as column_name
-                    FROM
-                        pg_index i
-                    JOIN
-                        pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
-                    WHERE
-                        i.indrelid = '{self.schema.database.databaseid}.{self.schema.schemaid}.{self.tableid}'::regclass
-                    AND
-                        i.indisprimary;
-                    """
-        elif self.schema.database.connection.provider_type == "redshift":
-            sql = f"""
-                    SELECT
-                        column_name
-                    FROM
-                        information_schema.key_column_usage
-                    WHERE
-                        table_name = '{self.tableid}'
-                    AND
-                        constraint_name = 'PRIMARY';
-                    """
-        elif self.schema.database.connection.provider_type == "snowflake":
-            sql = f"""
-                    SELECT
-                        constraint_name AS column_name
-                    FROM
-                        {self.schema.database.databaseid}.information_schema.table_constraints
-                    WHERE
-                        table_name = '{self.tableid}'
-                    AND
-                        constraint_type = 'PRIMARY KEY'
-                    AND
-                        table_schema = '{self.schema.schemaid}';
-                    """
-        else:
-            return None
-        ret = CARTO_API.execute_query(self.schema.database.connection.name, sql)
-        if len(ret["rows"]) > 0:
-            return ret["rows"][0]["column_name"]
-        return None
+        return self.schema.primary_keys().get(self.tableid)
+
+    @waitcursor
+    def tileset(self):
+        """
+        Returns the TileJSON of a dynamic vector tileset of the table, served
+        by the CARTO Maps API
+        """
+        geom_column = self.geom_column()
+        columns = [c["name"] for c in self.columns() if c["name"] != geom_column]
+        tilejson = CARTO_API.table_tileset(
+            self.schema.database.connection.name,
+            f"{self.schema.database.databaseid}.{self.schema.schemaid}.{self.tableid}",
+            geom_column,
+            columns,
+        )
+        tiles = tilejson.get("tiles")
+        if not tiles or not isinstance(tiles, list):
+            raise ValueError(f"The tileset of {self.name} has no tile URLs")
+        return tilejson
+
+    def select_list(self, columns=None, simplify_tolerance=None):
+        """
+        Returns the select list for querying the table. If columns is passed,
+        only those columns are selected, plus the primary key and the geometry
+        column. If simplify_tolerance is passed, geometries are simplified
+        server-side. Geometries are always selected in EPSG:4326
+        """
+        provider_type = self.schema.database.connection.provider_type
+        if (
+            columns is None
+            and simplify_tolerance is None
+            and provider_type not in PROVIDERS_WITH_SRID
+        ):
+            return "*"
+        geom_column = self.geom_column()
+        if columns is not None:
+            columns = set(columns) | {geom_column, self.pk()}
+        selected = []
+        for column in self.columns():
+            if columns is not None and column["name"] not in columns:
+                continue
+            name = quote_column_name_for_provider(column["name"], provider_type)
+            if column["name"] == geom_column:
+                geometry = geometry_4326_for_provider(provider_type, name)
+                if simplify_tolerance is not None:
+                    # simplified after the transform, as the tolerance is
+                    # converted to degrees
+                    geometry = simplify_geometry_for_provider(
+                        provider_type, geometry, simplify_tolerance
+                    )
+                selected.append(
+                    geometry if geometry == name else f"{geometry} AS {name}"
+                )
+            else:
+                selected.append(name)
+        return ", ".join(selected)
 
     @waitcursor
-    def get_rows(self, where=None):
+    def get_rows(self, where=None, columns=None):
         fqn = quote_for_provider(
             f"{self.schema.database.databaseid}.{self.schema.schemaid}.{self.tableid}",
             self.schema.database.connection.provider_type,
         )
         return CARTO_API.execute_query(
             self.schema.database.connection.name,
-            f"""SELECT * FROM {fqn}
+            f"""SELECT {self.select_list(columns)} FROM {fqn}
                 WHERE {where} ;""",
         )
 
@@ -0,0 +1,132 @@
+import traceback
+
+from qgis.core import (
+    QgsTask,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsRectangle,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from carto.core.api import CARTO_API
+from carto.core.metrics import log_task_requests
+from carto.core.features import memory_layer
+from carto.core.logging import error
+from carto.core.tilecache import TILE_CACHE, TileCache
+from carto.core.utils import (
+    quote_for_provider,
+    quote_column_name_for_provider,
+    centroid_coordinates_for_provider,
+)
+
+MAX_CELLS = 10000
+
+
+class DensityPreviewTask(QgsTask):
+    """
+    Aggregates the features of a table in a regular grid in the warehouse,
+    and creates a memory layer with one polygon per non-empty cell
+    """
+
+    def __init__(self, table, cell_size, aggregate_column=None, where="TRUE"):
+        super().__init__(f"Preview density of {table.name}", QgsTask.CanCancel)
+        self.exception = None
+        self.table = table
+        self.cell_size = cell_size
+        self.aggregate_column = aggregate_column
+        self.where = where
+        self.layer = None
+        self.truncated = False
+
+    @log_task_requests
+    def run(self):
+        try:
+            self.setProgress(1)
+            query = self._query()
+            table_id = TileCache.table_id(self.table)
+            key = TileCache.query_key(table_id, query, self.table.schema_version())
+            rows = TILE_CACHE.get(key)
+            if rows is None:
+                rows = CARTO_API.execute_query(
+                    self.table.schema.database.connection.name, query
+                )["rows"]
+                TILE_CACHE.put(key, table_id, rows)
+            if self.isCanceled():
+                return False
+            self.setProgress(80)
+            self.truncated = len(rows) >= MAX_CELLS
+            self.layer = self._create_layer(rows)
+            self.setProgress(100)
+            return True
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+
+    def _query(self):
+        provider_type = self.table.schema.database.connection.provider_type
+        fqn = quote_for_provider(
+            f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
+            provider_type,
+        )
+        geom_column = quote_column_name_for_provider(
+            self.table.geom_column(), provider_type
+        )
+        x, y = centroid_coordinates_for_provider(provider_type, geom_column)
+        inner_columns = [
+            f"FLOOR({x} / {self.cell_size}) AS cell_x",
+            f"FLOOR({y} / {self.cell_size}) AS cell_y",
+        ]
+        aggregates = ["COUNT(*) AS feature_count"]
+        if self.aggregate_column is not None:
+            column = quote_column_name_for_provider(
+                self.aggregate_column, provider_type
+            )
+            inner_columns.append(f"{column} AS aggregate_value")
+            aggregates.append("AVG(aggregate_value) AS avg_value")
+            aggregates.append("SUM(aggregate_value) AS sum_value")
+        return f"""
+            SELECT cell_x, cell_y, {", ".join(aggregates)}
+            FROM (
+                SELECT {", ".join(inner_columns)}
+                FROM {fqn}
+                WHERE ({self.where}) AND {geom_column} IS NOT NULL
+            ) cells
+            GROUP BY cell_x, cell_y
+            LIMIT {MAX_CELLS};
+        """
+
+    def _create_layer(self, rows):
+        fields = QgsFields()
+        fields.append(QgsField("feature_count", QVariant.LongLong))
+        if self.aggregate_column is not None:
+            fields.append(QgsField(f"avg_{self.aggregate_column}", QVariant.Double))
+            fields.append(QgsField(f"sum_{self.aggregate_column}", QVariant.Double))
+        layer = memory_layer(f"{self.table.name} (density)", "Polygon", fields)
+        features = []
+        for row in rows:
+            row = {k.lower(): v for k, v in row.items()}
+            cell_x = float(row["cell_x"])
+            cell_y = float(row["cell_y"])
+            feature = QgsFeature()
+            feature.setFields(fields)
+            feature.setGeometry(
+                QgsGeometry.fromRect(
+                    QgsRectangle(
+                        cell_x * self.cell_size,
+                        cell_y * self.cell_size,
+                        (cell_x + 1) * self.cell_size,
+                        (cell_y + 1) * self.cell_size,
+                    )
+                )
+            )
+            attributes = [int(row["feature_count"])]
+            if self.aggregate_column is not None:
+                attributes.extend([row.get("avg_value"), row.get("sum_value")])
+            feature.setAttributes(attributes)
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        layer.updateExtents()
+        return layer
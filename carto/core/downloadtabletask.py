@@ -1,53 +1,88 @@
+import math
 import traceback
 import os
-import base64
+from concurrent.futures import ThreadPoolExecutor
 
 from qgis.core import (
     QgsTask,
-    QgsGeometry,
 )
 
 from carto.core.layers import save_layer_metadata, filepath_for_table
+from carto.core.geopackage import finalize_geopackage
+from carto.core.jsonstream import RowStream
+from carto.core.memory import MemoryBudget
+from carto.core.tilecache import TILE_CACHE, TileCache
+from carto.core.features import (
+    fields_from_schema,
+    geometry_type_from_rows,
+    geometry_type_from_names,
+    memory_layer,
+    feature_from_row,
+    features_from_arrow,
+    converters_for_fields,
+)
 
 from carto.core.logging import (
     error,
+    info,
 )
 
 from carto.core.utils import (
     quote_for_provider,
+    quote_column_name_for_provider,
+    sample_clause_for_provider,
+    sample_predicate_for_provider,
+    geometry_type_expression_for_provider,
     download_file,
 )
 
 from carto.core.api import (
     CARTO_API,
 )
+from carto.core.profiling import profiled
+from carto.core.metrics import log_task_requests, REQUEST_LOG
 
 from qgis.core import (
     QgsVectorLayer,
-    QgsFeature,
-    QgsField,
-    QgsFields,
-    QgsGeometry,
-    QgsPointXY,
     QgsVectorFileWriter,
     QgsCoordinateReferenceSystem,
     QgsProject,
-    QgsWkbTypes,
 )
 
-
-from qgis.PyQt.QtCore import QVariant
+MAX_GEOMETRY_TYPES = 10
+PAGE_SIZE = 100
 
 
 class DownloadTableTask(QgsTask):
-    def __init__(self, table, where, limit):
+    def __init__(
+        self,
+        table,
+        where,
+        limit,
+        simplify_tolerance=None,
+        columns=None,
+        sample_size=None,
+        sample_seed=0,
+        row_count=None,
+    ):
         super().__init__(f"Download table {table.name}", QgsTask.CanCancel)
         self.exception = None
         self.table = table
         self.where = where
         self.limit = limit
+        self.simplify_tolerance = simplify_tolerance
+        self.columns = columns
+        self.sample_size = sample_size
+        self.sample_seed = sample_seed
+        # the number of rows matching the filter, if it is already known
+        self._row_count = row_count
         self.layer = None
+        self._select = "*"
+        self._sample_clause = ""
+        self._sample_where = self.where
 
+    @log_task_requests
+    @profiled
     def run(self):
         if self.table.schema.database.connection.provider_type == "bigquery":
             return self._download_using_sql()
@@ -91,183 +126,171 @@ class DownloadTableTask(QgsTask):
             return False
 
     def _download_using_sql(self):
+        # Table metadata needed for the layer is fetched while pages download
+        executor = ThreadPoolExecutor(
+            max_workers=3, thread_name_prefix="carto-download-metadata"
+        )
+        # the rows of the current page, closed if anything fails while they
+        # are read
+        rows = None
         try:
+            pk_future = executor.submit(REQUEST_LOG.bind(self.table.pk))
+            can_write_future = executor.submit(
+                REQUEST_LOG.bind(self.table.schema.can_write)
+            )
+            geometry_future = executor.submit(REQUEST_LOG.bind(self._geometry_info))
+            self._select = self.table.select_list(
+                self.columns, self.simplify_tolerance
+            )
             self.setProgress(1)
-            batch_size = min(100, self.limit or 100)
+            budget = MemoryBudget()
+            # the writer that features go to once they are spooled to disk
+            writer = None
+            geopackage_file = filepath_for_table(
+                self.table.schema.database.connection.name,
+                self.table.schema.database.databaseid,
+                self.table.schema.schemaid,
+                self.table.tableid,
+            )
+            os.makedirs(os.path.dirname(geopackage_file), exist_ok=True)
+            batch_size = min(PAGE_SIZE, self.limit or PAGE_SIZE)
             offset = 0
-            row_count = self.row_count()
+            row_count = self._row_count
+            if row_count is None:
+                row_count = self.row_count()
             if row_count == 0:
                 self.layer = None
                 return True
             max_rows = min(self.limit or row_count, row_count)
+            sampled = self.sample_size is not None and self.sample_size < row_count
+            if sampled:
+                self._prepare_sample(row_count, pk_future.result())
+                max_rows = min(max_rows, self.sample_size)
             while True:
-                where_with_offset = f"{self.where} LIMIT {batch_size} OFFSET {offset}"
+                where_with_offset = (
+                    f"{self._sample_where} LIMIT {batch_size} OFFSET {offset}"
+                )
                 data = self.get_rows(where_with_offset)
+                # columnar results have an Arrow table instead of rows, and
+                # streamed results have their rows parsed while iterated
+                table = data.get("table")
                 rows = data.get("rows", [])
                 if offset == 0:
-                    schema = data.get("schema", [])
-                    fields = QgsFields()
-                    geom_field = None
-                    for field in schema:
-                        field_name = field["name"]
-                        field_type = field["type"]
-                        if field_type == "string":
-                            fields.append(QgsField(field_name, QVariant.String))
-                        elif field_type in ["integer", "int", "bigint"]:
-                            fields.append(QgsField(field_name, QVariant.Int))
-                        elif field_type in ["double", "number", "float"]:
-                            fields.append(QgsField(field_name, QVariant.Double))
-                        elif field_type == "geometry":
-                            geom_field = field_name
-                    provider_type = self.table.schema.database.connection.provider_type
-                    geom_type = None
-                    if geom_field is not None:
-                        for row in rows:
-                            geom = row.get(geom_field)
-                            if geom is not None:
-                                if provider_type == "databricksRest":
-                                    try:
-                                        wkb_bytes = base64.b64decode(geom)
-                                        qgsgeom = QgsGeometry()
-                                        qgsgeom.fromWkb(wkb_bytes)
-                                        if qgsgeom.isGeosValid():
-                                            geom_type = QgsWkbTypes.displayString(
-                                                qgsgeom.wkbType()
-                                            )
-                                    except Exception:
-                                        try:
-                                            qgsgeom.fromWkt(geom)
-                                            if qgsgeom.isGeosValid():
-                                                geom_type = QgsWkbTypes.displayString(
-                                                    qgsgeom.wkbType()
-                                                )
-                                        except Exception:
-                                            try:
-                                                geom_type = geom.get("type")
-                                            except Exception:
-                                                geom_type = None
-                                else:
-                                    geom_type = geom.get("type")
-                                if geom_type is not None:
-                                    break
-                    layer = QgsVectorLayer(
-                        f"{geom_type}?crs=EPSG:4326", self.table.name, "memory"
+                    schema = data["schema"] if "schema" in data else rows.value("schema")
+                    if schema is None:
+                        raise Exception("The query result has no schema")
+                    try:
+                        geom_type, srid = geometry_future.result()
+                    except Exception:
+                        error(traceback.format_exc())
+                        geom_type, srid = None, None
+                    fields, geom_field = fields_from_schema(
+                        schema,
+                        self.table.schema.database.connection.provider_type,
+                        self._declared_columns(),
                     )
+                    converters = converters_for_fields(fields)
+                    if geom_type is None:
+                        if table is None:
+                            rows = list(rows)
+                        geom_type = geometry_type_from_rows(
+                            rows if table is None else table.to_pylist(), geom_field
+                        )
+                    # geometries are selected in EPSG:4326 whatever their SRID
+                    layer = memory_layer(self.table.name, geom_type, fields)
                     provider = layer.dataProvider()
-                    provider.addAttributes(fields)
-                    layer.updateFields()
-                    layer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
-
-                if len(rows) == 0:
-                    break
 
                 if self.isCanceled():
                     return False
 
-                def _set_geometry(f, g):
-                    try:
-                        wkb_bytes = base64.b64decode(g)
-                        qgsgeom = QgsGeometry()
-                        qgsgeom.fromWkb(wkb_bytes)
-                        f.setGeometry(qgsgeom)
-                    except Exception:
-                        try:
-                            qgsgeom.fromWkt(g)
-                            f.setGeometry(qgsgeom)
-                        except Exception:
-                            try:
-                                geom_type = g.get("type")
-                                coordinates = g.get("coordinates", [])
-                                if geom_type == "Point" and len(coordinates) == 2:
-                                    point = QgsPointXY(coordinates[0], coordinates[1])
-                                    f.setGeometry(QgsGeometry.fromPointXY(point))
-                                elif geom_type == "LineString":
-                                    line = [QgsPointXY(x, y) for x, y in coordinates]
-                                    f.setGeometry(QgsGeometry.fromPolylineXY(line))
-                                elif geom_type == "Polygon":
-                                    polygon = [
-                                        [QgsPointXY(x, y) for x, y in ring]
-                                        for ring in coordinates
-                                    ]
-                                    f.setGeometry(QgsGeometry.fromPolygonXY(polygon))
-                                elif geom_type == "MultiPoint":
-                                    multipoint = [
-                                        QgsPointXY(x, y) for x, y in coordinates
-                                    ]
-                                    f.setGeometry(
-                                        QgsGeometry.fromMultiPointXY(multipoint)
-                                    )
-                                elif geom_type == "MultiLineString":
-                                    multiline = [
-                                        [QgsPointXY(x, y) for x, y in line]
-                                        for line in coordinates
-                                    ]
-                                    f.setGeometry(
-                                        QgsGeometry.fromMultiPolylineXY(multiline)
-                                    )
-                                elif geom_type == "MultiPolygon":
-                                    multipolygon = [
-                                        [
-                                            [QgsPointXY(x, y) for x, y in ring]
-                                            for ring in polygon
-                                        ]
-                                        for polygon in coordinates
-                                    ]
-                                    f.setGeometry(
-                                        QgsGeometry.fromMultiPolygonXY(multipolygon)
-                                    )
-                            except Exception as e:
-                                print(e)
-
-                for item in rows:
-                    feature = QgsFeature()
-                    feature.setFields(fields)
-
-                    for field in fields:
-                        feature.setAttribute(field.name(), item.get(field.name()))
+                if table is not None:
+                    added = table.num_rows
+                    page_bytes = table.nbytes
+                    if not provider.addFeatures(
+                        list(features_from_arrow(table, fields, geom_field, geom_type))
+                    ):
+                        raise Exception(f"Could not add features to {layer.name()}")
+                else:
+                    added = 0
+                    for item in rows:
+                        if not provider.addFeature(
+                            feature_from_row(
+                                item, fields, geom_field, converters, geom_type
+                            )
+                        ):
+                            raise Exception(f"Could not add features to {layer.name()}")
+                        added += 1
+                    page_bytes = getattr(rows, "bytes_read", 0)
 
-                    geom = item.get(geom_field)
-                    if geom is not None:
-                        _set_geometry(feature, geom)
+                if added == 0:
+                    break
 
-                    provider.addFeature(feature)
+                if writer is None and budget.exceeded():
+                    writer = self._spool(layer, geopackage_file)
+                    provider = writer
 
-                if offset + batch_size >= max_rows:
+                offset += added
+                # a short page is the last one
+                if offset >= max_rows or added < batch_size:
                     break
-                offset += batch_size
-                self.setProgress(min((offset + batch_size) / row_count, 1) * 90)
-
-            geopackage_file = filepath_for_table(
-                self.table.schema.database.connection.name,
-                self.table.schema.database.databaseid,
-                self.table.schema.schemaid,
-                self.table.tableid,
-            )
-            os.makedirs(os.path.dirname(geopackage_file), exist_ok=True)
+                # once the features are written to disk, pages don't add up
+                # in memory, and the memory of the process doesn't shrink, so
+                # they go back to the default size instead of the smallest one
+                page_size = (
+                    budget.page_size(page_bytes / added, batch_size)
+                    if writer is None
+                    else PAGE_SIZE
+                )
+                batch_size = min(page_size, max_rows - offset)
+                self.setProgress(min(offset / max_rows, 1) * 90)
 
-            options = QgsVectorFileWriter.SaveVectorOptions()
-            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
-            options.layerName = layer.name()
-            _writer = QgsVectorFileWriter.writeAsVectorFormatV3(
-                layer,
-                geopackage_file,
-                QgsProject.instance().transformContext(),
-                options,
-            )
+            if writer is None:
+                QgsVectorFileWriter.writeAsVectorFormatV3(
+                    layer,
+                    geopackage_file,
+                    QgsProject.instance().transformContext(),
+                    self._save_options(layer),
+                )
+            else:
+                # deleting the writer closes the file
+                provider = writer = None
+            budget.report(self.description())
+            self.setProgress(95)
+            pk = pk_future.result()
+            indexes = finalize_geopackage(geopackage_file, layer.name(), pk)
 
             layer_metadata = {
-                "pk": self.table.pk(),
+                "pk": pk,
                 "columns": schema,
                 "geom_column": geom_field,
-                "can_write": self.table.schema.can_write(),
+                # the SRID of the table geometries, which are transformed back
+                # to it from EPSG:4326 when changes are synced
+                "srid": srid,
+                # simplified geometries must never be synced back
+                "can_write": can_write_future.result()
+                and self.simplify_tolerance is None,
+                "simplify_tolerance": self.simplify_tolerance,
+                # None if all the columns of the table were downloaded
+                "projected_columns": self.columns,
+                "sample": {"size": self.sample_size, "seed": self.sample_seed}
+                if sampled
+                else None,
+                # the filter, so the table can be downloaded again with it
+                "where": self.where,
+                "limit": self.limit,
                 "schema_changed": False,
                 "provider_type": self.table.schema.database.connection.provider_type,
+                "extent": indexes["extent"],
+                "spatial_index": indexes["spatial_index"],
+                "pk_index": indexes["pk_index"],
             }
             gpkglayer = QgsVectorLayer(
                 f"{geopackage_file}|layername={self.table.name}", self.table.name, "ogr"
             )
             # gpkglayer.setCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
             save_layer_metadata(gpkglayer, layer_metadata)
+            # the table was read again, so its cached rows may be stale
+            TILE_CACHE.invalidate(TileCache.table_id(self.table))
             self.setProgress(100)
             self.layer = gpkglayer
 
@@ -276,6 +299,109 @@ class DownloadTableTask(QgsTask):
             self.exception = traceback.format_exc()
             error(self.exception)
             return False
+        finally:
+            if isinstance(rows, RowStream):
+                rows.close()
+            executor.shutdown(wait=False)
+
+    def _declared_columns(self):
+        """
+        Returns the columns of the table as in its metadata, which have the
+        precision and scale of decimals, or None if they can't be read
+        """
+        try:
+            return self.table.columns()
+        except Exception:
+            error(traceback.format_exc())
+            return None
+
+    def _save_options(self, layer):
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteFile
+        options.layerName = layer.name()
+        options.layerOptions = ["SPATIAL_INDEX=YES"]
+        return options
+
+    def _spool(self, layer, geopackage_file):
+        """
+        Moves the features downloaded so far to the geopackage, and returns
+        a writer to add the rest of them there, instead of keeping them in
+        memory
+        """
+        writer = QgsVectorFileWriter.create(
+            geopackage_file,
+            layer.fields(),
+            layer.wkbType(),
+            layer.crs(),
+            QgsProject.instance().transformContext(),
+            self._save_options(layer),
+        )
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise Exception(writer.errorMessage())
+        for feature in layer.getFeatures():
+            if not writer.addFeature(feature):
+                raise Exception(writer.lastError())
+        layer.dataProvider().truncate()
+        info(f"{self.description()}: memory budget exceeded, writing to disk")
+        return writer
+
+    def _prepare_sample(self, row_count, pk):
+        """
+        Sets the sampling clause or predicate used to get the rows. The
+        sampled percent is a bit over the one needed for the target size,
+        so a Bernoulli sample falls short of it only rarely, and the sample
+        is then cut to the target size by the row limit
+        """
+        provider_type = self.table.schema.database.connection.provider_type
+        expected = self.sample_size + 3 * math.sqrt(self.sample_size)
+        percent = min(100, expected / row_count * 100)
+        self._sample_clause = (
+            sample_clause_for_provider(provider_type, percent, self.sample_seed) or ""
+        )
+        if not self._sample_clause:
+            if pk is not None:
+                key_column = quote_column_name_for_provider(pk, provider_type)
+            else:
+                geom_column = quote_column_name_for_provider(
+                    self.table.geom_column(), provider_type
+                )
+                key_column = f"ST_ASTEXT({geom_column})"
+            predicate = sample_predicate_for_provider(
+                provider_type, key_column, percent, self.sample_seed
+            )
+            self._sample_where = f"({self.where}) AND {predicate}"
+
+    def _geometry_info(self):
+        """
+        Returns the geometry type and SRID of the rows to download, from the
+        distinct geometry types and SRIDs in the table. The SRID is None if
+        it is unknown or not unique
+        """
+        provider_type = self.table.schema.database.connection.provider_type
+        geom_column = self.table.geom_column()
+        if geom_column is None:
+            return None, None
+        fqn = quote_for_provider(
+            f"{self.table.schema.database.databaseid}.{self.table.schema.schemaid}.{self.table.tableid}",
+            provider_type,
+        )
+        quoted_geom_column = quote_column_name_for_provider(geom_column, provider_type)
+        type_expression, srid_expression = geometry_type_expression_for_provider(
+            provider_type, quoted_geom_column
+        )
+        expressions = [f"{type_expression} AS geom_type"]
+        if srid_expression is not None:
+            expressions.append(f"{srid_expression} AS srid")
+        ret = CARTO_API.execute_query(
+            self.table.schema.database.connection.name,
+            f"""SELECT DISTINCT {", ".join(expressions)} FROM {fqn}
+                WHERE ({self.where}) AND {quoted_geom_column} IS NOT NULL
+                LIMIT {MAX_GEOMETRY_TYPES};""",
+        )
+        rows = [{k.lower(): v for k, v in row.items()} for row in ret.get("rows", [])]
+        geom_type = geometry_type_from_names(row.get("geom_type") for row in rows)
+        srids = {row.get("srid") for row in rows if row.get("srid")}
+        return geom_type, srids.pop() if len(srids) == 1 else None
 
     def get_rows(self, where=None):
         fqn = quote_for_provider(
@@ -284,8 +410,10 @@ class DownloadTableTask(QgsTask):
         )
         return CARTO_API.execute_query(
             self.table.schema.database.connection.name,
-            f"""SELECT * FROM {fqn}
+            f"""SELECT {self._select} FROM {fqn} {self._sample_clause}
                 WHERE {where} ;""",
+            columnar=True,
+            stream=True,
         )
 
     def row_count(self):
@@ -30,3 +30,14 @@ class AuthState(Enum):
     NotAuthorized = auto()
     Authorizing = auto()
     Authorized = auto()
+
+
+class TaskPriority(Enum):
+    """
+    Priority classes of the tasks run by the CARTO task scheduler, from
+    the most to the least urgent
+    """
+
+    Interactive = auto()
+    Metadata = auto()
+    Bulk = auto()
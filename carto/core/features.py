@@ -0,0 +1,377 @@
+import base64
+import json
+
+from qgis.core import (
+    QgsVectorLayer,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsGeometryCollection,
+    QgsPointXY,
+    QgsCoordinateReferenceSystem,
+    QgsWkbTypes,
+)
+
+from qgis.PyQt.QtCore import QVariant, QDate, QTime, QDateTime, Qt
+
+from carto.core.logging import error
+from carto.core.utils import qgis_type_from_provider_data_type
+
+
+def fields_from_schema(schema, provider_type=None, columns=None):
+    """
+    Returns the QGIS fields for a schema returned by the SQL API, and the
+    name of the geometry column (None if there is no geometry column).
+
+    columns are the columns of the table, as in its metadata. Their types
+    are used for the fields whose type in the schema has no precision and
+    scale, which are needed to tell integer decimals apart
+    """
+    declared = {column["name"]: column["type"] for column in columns or []}
+    fields = QgsFields()
+    geom_field = None
+    for field in schema:
+        field_name = field["name"]
+        data_type = field["type"]
+        if "(" in declared.get(field_name, "") and field.get("scale") is None:
+            data_type = declared[field_name]
+        field_type = qgis_type_from_provider_data_type(
+            data_type, provider_type, field.get("precision"), field.get("scale")
+        )
+        if field_type == "geometry":
+            geom_field = field_name
+        else:
+            fields.append(QgsField(field_name, field_type))
+    return fields, geom_field
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ["true", "t", "1", "yes"]
+    return bool(value)
+
+
+def _to_string(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _iso(value):
+    # some providers separate date and time with a space
+    return str(value).replace(" ", "T", 1)
+
+
+def _to_datetime(value):
+    if isinstance(value, (int, float)):
+        return QDateTime.fromMSecsSinceEpoch(int(value * 1000), Qt.UTC)
+    return QDateTime.fromString(_iso(value), Qt.ISODate)
+
+
+_converters = {
+    QVariant.String: _to_string,
+    QVariant.Int: _to_int,
+    QVariant.LongLong: _to_int,
+    QVariant.Double: float,
+    QVariant.Bool: _to_bool,
+    QVariant.Date: lambda value: QDate.fromString(str(value)[:10], Qt.ISODate),
+    QVariant.Time: lambda value: QTime.fromString(str(value), Qt.ISODate),
+    QVariant.DateTime: _to_datetime,
+}
+
+
+def converters_for_fields(fields):
+    """
+    Returns the functions that convert the values in result rows to the
+    type of each field. They are computed once per schema and passed to
+    feature_from_row
+    """
+    return [_converters.get(field.type()) for field in fields]
+
+
+_geometry_types = {
+    "point": "Point",
+    "linestring": "LineString",
+    "polygon": "Polygon",
+    "multipoint": "MultiPoint",
+    "multilinestring": "MultiLineString",
+    "multipolygon": "MultiPolygon",
+    "geometrycollection": "GeometryCollection",
+}
+
+
+def geometry_type_from_names(names):
+    """
+    Returns the layer geometry type for the geometry types found in a
+    column, as named by the provider (POINT, ST_Point, Point...). Mixed
+    single and multi types are promoted to the multi type, and mixed or
+    unknown geometry families to a geometry collection, as layers can't
+    hold geometries of different families
+    """
+    geom_types = set()
+    for name in names:
+        if not name:
+            continue
+        name = name.lower().replace("st_", "", 1).replace("_", "").replace(" ", "")
+        for suffix in ["zm", "m", "z"]:
+            if name.endswith(suffix) and name[: -len(suffix)] in _geometry_types:
+                name = name[: -len(suffix)]
+                break
+        geom_type = _geometry_types.get(name)
+        if geom_type is None:
+            return "GeometryCollection"
+        geom_types.add(geom_type)
+    if not geom_types:
+        return None
+    if len(geom_types) == 1:
+        return geom_types.pop()
+    single_types = {t[len("Multi") :] if t.startswith("Multi") else t for t in geom_types}
+    if len(single_types) == 1:
+        return f"Multi{single_types.pop()}"
+    return "GeometryCollection"
+
+
+def geometry_type_from_rows(rows, geom_field):
+    """
+    Returns the geometry type of the first non-null geometry in the rows.
+    Used when the geometry types can't be queried from the table
+    """
+    if geom_field is None:
+        return None
+    for row in rows:
+        geom = row.get(geom_field)
+        if geom is None:
+            continue
+        if isinstance(geom, dict):
+            geom_type = geom.get("type")
+        else:
+            qgsgeom = QgsGeometry()
+            try:
+                qgsgeom.fromWkb(geom if isinstance(geom, bytes) else base64.b64decode(geom))
+            except Exception:
+                pass
+            # Arrow results have WKB bytes, which can't be WKT
+            if qgsgeom.isNull() and isinstance(geom, str):
+                qgsgeom = QgsGeometry.fromWkt(geom)
+            geom_type = (
+                None
+                if qgsgeom.isNull()
+                else QgsWkbTypes.displayString(qgsgeom.wkbType())
+            )
+        if geom_type is not None:
+            return geom_type
+    return None
+
+
+def memory_layer(name, geom_type, fields, crs="EPSG:4326"):
+    layer = QgsVectorLayer(f"{geom_type}?crs={crs}", name, "memory")
+    layer.dataProvider().addAttributes(fields)
+    layer.updateFields()
+    layer.setCrs(QgsCoordinateReferenceSystem(crs))
+    return layer
+
+
+def set_feature_geometry(f, g):
+    try:
+        wkb_bytes = base64.b64decode(g)
+        qgsgeom = QgsGeometry()
+        qgsgeom.fromWkb(wkb_bytes)
+        f.setGeometry(qgsgeom)
+    except Exception:
+        try:
+            qgsgeom.fromWkt(g)
+            f.setGeometry(qgsgeom)
+        except Exception:
+            try:
+                geom_type = g.get("type")
+                coordinates = g.get("coordinates", [])
+                if geom_type == "Point" and len(coordinates) == 2:
+                    point = QgsPointXY(coordinates[0], coordinates[1])
+                    f.setGeometry(QgsGeometry.fromPointXY(point))
+                elif geom_type == "LineString":
+                    line = [QgsPointXY(x, y) for x, y in coordinates]
+                    f.setGeometry(QgsGeometry.fromPolylineXY(line))
+                elif geom_type == "Polygon":
+                    polygon = [
+                        [QgsPointXY(x, y) for x, y in ring] for ring in coordinates
+                    ]
+                    f.setGeometry(QgsGeometry.fromPolygonXY(polygon))
+                elif geom_type == "MultiPoint":
+                    multipoint = [QgsPointXY(x, y) for x, y in coordinates]
+                    f.setGeometry(QgsGeometry.fromMultiPointXY(multipoint))
+                elif geom_type == "MultiLineString":
+                    multiline = [
+                        [QgsPointXY(x, y) for x, y in line] for line in coordinates
+                    ]
+                    f.setGeometry(QgsGeometry.fromMultiPolylineXY(multiline))
+                elif geom_type == "MultiPolygon":
+                    multipolygon = [
+                        [[QgsPointXY(x, y) for x, y in ring] for ring in polygon]
+                        for polygon in coordinates
+                    ]
+                    f.setGeometry(QgsGeometry.fromMultiPolygonXY(multipolygon))
+            except Exception as e:
+                error(f"Could not read geometry: {e}")
+
+
+def geometry_for_layer(geometry, geom_type):
+    """
+    Returns the geometry converted to the geometry type of the layer it is
+    added to, which rejects geometries of other types
+    """
+    if geom_type is None or geometry.isNull():
+        return geometry
+    if geom_type == "GeometryCollection":
+        if QgsWkbTypes.flatType(geometry.wkbType()) != QgsWkbTypes.GeometryCollection:
+            collection = QgsGeometryCollection()
+            for part in geometry.constParts():
+                collection.addGeometry(part.clone())
+            geometry = QgsGeometry(collection)
+    elif geom_type.startswith("Multi") and not geometry.isMultipart():
+        geometry.convertToMultiType()
+    return geometry
+
+
+def normalize_rows(rows, geom_field):
+    """
+    Returns a copy of the rows with their geometries as base64-encoded WKB,
+    which is the cheapest representation to decode again
+    """
+    if geom_field is None:
+        return rows
+    normalized = []
+    for row in rows:
+        row = dict(row)
+        geom = row.get(geom_field)
+        if geom is not None:
+            feature = QgsFeature()
+            set_feature_geometry(feature, geom)
+            wkb = bytes(feature.geometry().asWkb())
+            row[geom_field] = base64.b64encode(wkb).decode()
+        normalized.append(row)
+    return normalized
+
+
+def feature_from_row(row, fields, geom_field, converters=None, geom_type=None):
+    feature = QgsFeature()
+    feature.setFields(fields)
+
+    for i, field in enumerate(fields):
+        value = row.get(field.name())
+        if value is not None and converters and converters[i] is not None:
+            try:
+                value = converters[i](value)
+            except (TypeError, ValueError):
+                value = None
+        feature.setAttribute(i, value)
+
+    geom = row.get(geom_field)
+    if geom is not None:
+        set_feature_geometry(feature, geom)
+        if geom_type is not None and feature.hasGeometry():
+            feature.setGeometry(geometry_for_layer(feature.geometry(), geom_type))
+    return feature
+
+
+_arrow_types = {
+    "bool": "boolean",
+    "int8": "int2",
+    "int16": "int2",
+    "int32": "int4",
+    "int64": "bigint",
+    "uint8": "int2",
+    "uint16": "int4",
+    "uint32": "bigint",
+    "uint64": "bigint",
+    "halffloat": "float",
+    "float": "float",
+    "double": "double",
+    "date32[day]": "date",
+    "date64[ms]": "date",
+}
+
+
+def schema_from_arrow(arrow_schema):
+    """
+    Returns the schema of an Arrow result in the format of the schemas of
+    JSON results. Geometry columns are WKB columns with a GeoArrow
+    extension type
+    """
+    schema = []
+    for field in arrow_schema:
+        metadata = field.metadata or {}
+        extension = metadata.get(b"ARROW:extension:name", b"").decode()
+        data_type = str(field.type)
+        if extension in ["geoarrow.wkb", "ogc.wkb"]:
+            data_type = "geometry"
+        elif data_type.startswith("timestamp"):
+            data_type = "timestamp"
+        elif data_type.startswith("time"):
+            data_type = "time"
+        elif data_type.startswith("decimal"):
+            # the precision and scale tell integer decimals apart
+            schema.append(
+                {
+                    "name": field.name,
+                    "type": "decimal",
+                    "precision": field.type.precision,
+                    "scale": field.type.scale,
+                }
+            )
+            continue
+        else:
+            data_type = _arrow_types.get(data_type, "string")
+        schema.append({"name": field.name, "type": data_type})
+    return schema
+
+
+# Arrow values are converted to Python values of the right type already,
+# only the ones without a QVariant equivalent need to be converted
+_arrow_converters = {
+    QVariant.String: lambda value: value if isinstance(value, str) else _to_string(value),
+    # integer decimals are read as Decimal values
+    QVariant.LongLong: int,
+    QVariant.Double: float,
+    QVariant.Date: QDate,
+    QVariant.Time: QTime,
+    QVariant.DateTime: QDateTime,
+}
+
+
+def features_from_arrow(table, fields, geom_field, geom_type=None):
+    """
+    Yields the features for the rows of an Arrow table. Values are read a
+    record batch at a time, a column at a time, instead of as dicts for
+    each row
+    """
+    converters = [_arrow_converters.get(field.type()) for field in fields]
+    for batch in table.to_batches():
+        columns = []
+        for field, converter in zip(fields, converters):
+            index = batch.schema.get_field_index(field.name())
+            values = batch.column(index).to_pylist() if index != -1 else None
+            if values is not None and converter is not None:
+                values = [None if v is None else converter(v) for v in values]
+            columns.append(values or [None] * batch.num_rows)
+        geoms = (
+            batch.column(batch.schema.get_field_index(geom_field)).to_pylist()
+            if geom_field is not None
+            else [None] * batch.num_rows
+        )
+        rows = zip(*columns) if columns else [()] * batch.num_rows
+        for attributes, wkb in zip(rows, geoms):
+            feature = QgsFeature(fields)
+            feature.setAttributes(list(attributes))
+            if wkb is not None:
+                geometry = QgsGeometry()
+                geometry.fromWkb(wkb)
+                feature.setGeometry(geometry_for_layer(geometry, geom_type))
+            yield feature
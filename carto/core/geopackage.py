@@ -0,0 +1,58 @@
+import sqlite3
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def finalize_geopackage(path, layer_name, pk=None):
+    """
+    Builds the indexes and statistics of a downloaded GeoPackage table, so
+    it doesn't need to be done lazily when the layer is first rendered or
+    queried. Returns a dict describing what was built, to be stored in the
+    layer metadata
+    """
+    result = {"spatial_index": False, "pk_index": None, "extent": None}
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute(
+            "SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?",
+            (layer_name,),
+        ).fetchone()
+        if row is not None:
+            rtree = f"rtree_{layer_name}_{row[0]}"
+            exists = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)
+            ).fetchone()
+            result["spatial_index"] = exists is not None
+            if exists is not None:
+                extent = connection.execute(
+                    f"SELECT MIN(minx), MIN(miny), MAX(maxx), MAX(maxy) FROM {_quote(rtree)}"
+                ).fetchone()
+                if extent[0] is not None:
+                    result["extent"] = list(extent)
+                    connection.execute(
+                        """UPDATE gpkg_contents
+                            SET min_x = ?, min_y = ?, max_x = ?, max_y = ?
+                            WHERE table_name = ?""",
+                        (*extent, layer_name),
+                    )
+        if pk is not None:
+            columns = [
+                c[1]
+                for c in connection.execute(
+                    f"PRAGMA table_info({_quote(layer_name)})"
+                ).fetchall()
+            ]
+            if pk in columns:
+                index_name = f"idx_{layer_name}_{pk}"
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS {_quote(index_name)} "
+                    f"ON {_quote(layer_name)} ({_quote(pk)})"
+                )
+                result["pk_index"] = index_name
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+    return result
@@ -11,9 +11,14 @@ from carto.core.utils import (
     prepare_multipart_sql,
 )
 from carto.core.api import CARTO_API
+from carto.core.profiling import profiled
+from carto.core.metrics import log_task_requests
+from carto.core.memory import MemoryBudget
 
 from qgis.PyQt.QtCore import QVariant
 
+BATCH_SIZE = 10
+
 
 class ImportLayerTask(QgsTask):
     def __init__(
@@ -30,6 +35,8 @@ class ImportLayerTask(QgsTask):
         self.connection_name = connection_name
         self.provider_type = provider_type
 
+    @log_task_requests
+    @profiled
     def run(self):
         try:
             self.setProgress(0)
@@ -54,7 +61,10 @@ class ImportLayerTask(QgsTask):
             for statement in sql_create:
                 CARTO_API.execute_query(self.connection_name, statement)
             self.setProgress(1)
+            budget = MemoryBudget()
+            total = max(1, self.layer.featureCount())
             insert_statements = []
+            imported = 0
 
             for feature in self.layer.getFeatures():
                 if self.isCanceled():
@@ -83,35 +93,26 @@ class ImportLayerTask(QgsTask):
                     f"INSERT INTO {fqn} VALUES (" + ", ".join(field_values) + ");"
                 )
                 insert_statements.append(insert_statement)
-
-            batch_size = 10
-            num_batches = len(insert_statements) // batch_size
-            for i in range(num_batches):
-                if self.isCanceled():
-                    return False
-                sql = prepare_multipart_sql(
-                    insert_statements[i * batch_size : (i + 1) * batch_size],
-                    self.provider_type,
-                    self.fqn,
-                )
-                for statement in sql:
-                    CARTO_API.execute_query_post(
-                        self.connection_name,
-                        statement,
-                    )
-                self.setProgress(int(i / num_batches * 100))
-            if (num_batches * batch_size) < len(insert_statements):
-                sql = prepare_multipart_sql(
-                    insert_statements[num_batches * batch_size :],
-                    self.provider_type,
-                    self.fqn,
-                )
-                for statement in sql:
-                    CARTO_API.execute_query_post(
-                        self.connection_name,
-                        statement,
-                    )
+                # statements are sent as they are built, so they are never
+                # all in memory
+                if len(insert_statements) == BATCH_SIZE:
+                    self._insert(insert_statements)
+                    imported += len(insert_statements)
+                    insert_statements = []
+                    budget.used()
+                    self.setProgress(int(imported / total * 100))
+            if insert_statements:
+                self._insert(insert_statements)
+            budget.report(self.description())
             return True
         except Exception:
             self.exception = traceback.format_exc()
             return False
+
+    def _insert(self, insert_statements):
+        sql = prepare_multipart_sql(insert_statements, self.provider_type, self.fqn)
+        for statement in sql:
+            CARTO_API.execute_query_post(
+                self.connection_name,
+                statement,
+            )
@@ -0,0 +1,142 @@
+import codecs
+import json
+import re
+import time
+from collections import deque
+
+CHUNK_SIZE = 64 * 1024
+
+_whitespace = re.compile(r"\s*")
+
+
+class RowStream:
+    """
+    Parses the JSON response of a query while it is downloaded. Iterating
+    it yields each row as soon as it has been received, so the whole body
+    and all the parsed rows don't have to be in memory at once. The other
+    values of the response, like the schema, are returned by value(). If
+    they come after the rows, the rows before them are kept until they are
+    iterated.
+
+    on_close is called with the stream when the response has been read,
+    or when the stream is closed before that
+    """
+
+    def __init__(self, chunks, key="rows", on_close=None):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+        self._key = key
+        self._parser = self._parse()
+        self._pending = deque()
+        self._done = False
+        self._closed = False
+        self._on_close = on_close
+        self.values = {}
+        self.bytes_read = 0
+        self.read_time = 0
+        self.parse_time = 0
+
+    def __iter__(self):
+        while self._pending or not self._done:
+            if self._pending:
+                yield self._pending.popleft()
+                continue
+            row = self._next()
+            if row is not None:
+                yield row
+        self.close()
+
+    def value(self, name):
+        """
+        Returns a value of the response other than the rows, parsing the
+        response until it is found
+        """
+        while name not in self.values and not self._done:
+            row = self._next()
+            if row is not None:
+                self._pending.append(row)
+        return self.values.get(name)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _next(self):
+        start = time.perf_counter()
+        read_time = self.read_time
+        try:
+            return next(self._parser)
+        except StopIteration:
+            self._done = True
+            self.close()
+            return None
+        finally:
+            elapsed = time.perf_counter() - start
+            self.parse_time += elapsed - (self.read_time - read_time)
+
+    def _parse(self):
+        self._expect("{")
+        while self._peek() != "}":
+            if self._peek() == ",":
+                self._pos += 1
+            key = self._decode()
+            self._expect(":")
+            if key != self._key:
+                self.values[key] = self._decode()
+                continue
+            self._expect("[")
+            while self._peek() != "]":
+                if self._peek() == ",":
+                    self._pos += 1
+                yield self._decode()
+            self._pos += 1
+
+    def _read(self):
+        if self._exhausted:
+            raise ValueError("Unexpected end of the JSON response")
+        start = time.perf_counter()
+        chunk = next(self._chunks, None)
+        self.read_time += time.perf_counter() - start
+        # the parsed part of the buffer is dropped, to keep it small
+        self._buffer = self._buffer[self._pos :]
+        self._pos = 0
+        if chunk is None:
+            self._exhausted = True
+            self._buffer += self._text.decode(b"", final=True)
+        else:
+            self.bytes_read += len(chunk)
+            self._buffer += self._text.decode(chunk)
+
+    def _peek(self):
+        self._pos = _whitespace.match(self._buffer, self._pos).end()
+        while self._pos >= len(self._buffer):
+            self._read()
+            self._pos = _whitespace.match(self._buffer, self._pos).end()
+        return self._buffer[self._pos]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' in the JSON response")
+        self._pos += 1
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # a number at the end of the buffer might continue in the
+                # next chunk
+                if end < len(self._buffer) or self._exhausted:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+            self._read()
@@ -18,6 +18,7 @@ from qgis.core import (
 
 from carto.core.api import CARTO_API
 from carto.core.logging import error
+from carto.core.profiling import profiled
 from carto.core.utils import (
     quote_for_provider,
     quote_column_name_for_provider,
@@ -120,7 +121,16 @@ class LayerTracker:
         self.connected[layer.id()].append(feature_removed_func)
 
     @waitcursor
+    @profiled
     def upload_changes(self, layer):
+        if is_simplified(layer):
+            iface.messageBar().pushMessage(
+                "Layer geometries were simplified. Local changes will not be saved to the original table",
+                level=Qgis.Warning,
+                duration=5,
+            )
+            return
+
         if not can_write(layer):
             iface.messageBar().pushMessage(
                 "No permission to write. Local changes will not be saved to the original table",
@@ -143,6 +153,9 @@ class LayerTracker:
             )
             return
 
+        # these are the columns present locally. If the download was projected
+        # to a subset of columns, the rest are not touched by the changes, and
+        # inserted features get the table defaults for them
         original_columns = [
             c["name"] for c in metadata["columns"] if c["type"] != "geometry"
         ]
@@ -204,7 +217,9 @@ class LayerTracker:
                     pk_value,
                     layer.fields().at(layer.fields().indexOf(pk_field)).isNumeric(),
                 )
-                geo_value = prepare_geo_value_for_provider(provider_type, geom)
+                geo_value = prepare_geo_value_for_provider(
+                    provider_type, geom, metadata.get("srid")
+                )
                 statements.append(
                     f"UPDATE {quoted_fqn} SET {geom_column} = {geo_value} WHERE {pk_field} {pk_operator(pk_value)};"
                 )
@@ -226,7 +241,9 @@ class LayerTracker:
                 values = []
                 if geom_column is not None:
                     geom = feature.geometry()
-                    geo_value = prepare_geo_value_for_provider(provider_type, geom)
+                    geo_value = prepare_geo_value_for_provider(
+                        provider_type, geom, metadata.get("srid")
+                    )
                     fields.append(geom_column)
                     values.append(geo_value)
                 for i in range(feature.fields().count()):
@@ -250,6 +267,7 @@ class LayerTracker:
             sql = prepare_multipart_sql(statements, provider_type, fqn)
             for statement in sql:
                 CARTO_API.execute_query(connection, statement)
+            invalidate_cached_rows(layer)
             iface.messageBar().pushMessage(
                 "Layer changes uploaded", level=Qgis.Success, duration=5
             )
@@ -303,6 +321,22 @@ def fqn_from_layer(layer):
     return ".".join([parts[-2], parts[-1], tablename])
 
 
+def invalidate_cached_rows(layer):
+    """
+    Drops the rows of the table of a layer from the tile cache, so live
+    layers and density previews don't show them after it is changed
+    """
+    # imported here, as the tile cache is stored in the layers folder
+    from carto.core.tilecache import TILE_CACHE, TileCache
+
+    path = os.path.dirname(layer.source())
+    connection_name, databaseid, schemaid = path.split(os.path.sep)[-3:]
+    tableid = os.path.splitext(os.path.basename(layer.source()))[0]
+    TILE_CACHE.invalidate(
+        TileCache.table_id_for(connection_name, databaseid, schemaid, tableid)
+    )
+
+
 def metadata_file(layer):
     return layer.source().split("|")[0] + ".cartometadata"
 
@@ -313,6 +347,18 @@ def layer_metadata(layer):
     return metadata
 
 
+def table_metadata(geopackage_file):
+    """
+    Returns the metadata of a downloaded table, or None if the table
+    hasn't been downloaded
+    """
+    path = geopackage_file + ".cartometadata"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
 def save_layer_metadata(layer, metadata):
     with open(metadata_file(layer), "w") as f:
         json.dump(metadata, f)
@@ -333,6 +379,11 @@ def can_write(layer):
     return metadata["can_write"]
 
 
+def is_simplified(layer):
+    metadata = layer_metadata(layer)
+    return metadata.get("simplify_tolerance") is not None
+
+
 def geom_column_from_layer(layer):
     metadata = layer_metadata(layer)
     return metadata["geom_column"]
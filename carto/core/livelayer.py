@@ -0,0 +1,248 @@
+import json
+import traceback
+
+from qgis.core import (
+    Qgis,
+    QgsTask,
+    QgsProject,
+    QgsRectangle,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+)
+from qgis.PyQt.QtCore import QObject, QTimer
+from qgis.utils import iface
+
+from carto.core.api import CARTO_API
+from carto.core.metrics import log_task_requests
+from carto.core.features import (
+    fields_from_schema,
+    geometry_type_from_rows,
+    memory_layer,
+    feature_from_row,
+    normalize_rows,
+    converters_for_fields,
+)
+from carto.core.enums import TaskPriority
+from carto.core.logging import error
+from carto.core.scheduler import TASK_SCHEDULER
+from carto.core.tiles import (
+    MAX_LATITUDE,
+    tile_bounds,
+    tiles_for_extent,
+    zoom_for_extent,
+    parent_tiles,
+)
+from carto.core.tilecache import TILE_CACHE, TileCache
+from carto.core.utils import quote_for_provider, spatial_filter_for_provider
+
+MAX_FEATURES_PER_TILE = 5000
+MAX_VISIBLE_TILES = 16
+UPDATE_DELAY = 300
+
+
+def fetch_tile(table, where, geom_column, tile):
+    provider_type = table.schema.database.connection.provider_type
+    fqn = quote_for_provider(
+        f"{table.schema.database.databaseid}.{table.schema.schemaid}.{table.tableid}",
+        provider_type,
+    )
+    spatial_filter = spatial_filter_for_provider(
+        provider_type, geom_column, tile_bounds(*tile)
+    )
+    return CARTO_API.execute_query(
+        table.schema.database.connection.name,
+        f"""SELECT {table.select_list()} FROM {fqn}
+            WHERE ({where}) AND {spatial_filter}
+            LIMIT {MAX_FEATURES_PER_TILE};""",
+    )
+
+
+def fetch_tile_cached(table, where, geom_column, tile, version):
+    table_id = TileCache.table_id(table)
+    key = TileCache.key(table_id, where, tile, version)
+    data = TILE_CACHE.get(key)
+    if data is None:
+        data = fetch_tile(table, where, geom_column, tile)
+        schema = data.get("schema", [])
+        _, geom_field = fields_from_schema(
+            schema, table.schema.database.connection.provider_type
+        )
+        data = {
+            "schema": schema,
+            "rows": normalize_rows(data.get("rows", []), geom_field),
+        }
+        TILE_CACHE.put(key, table_id, data)
+    return data
+
+
+class FetchTilesTask(QgsTask):
+    def __init__(self, table, where, tiles):
+        super().__init__(f"Loading {table.name}", QgsTask.CanCancel)
+        self.exception = None
+        self.table = table
+        self.where = where
+        self.tiles = tiles
+        self.pk = None
+        self.results = {}
+
+    @log_task_requests
+    def run(self):
+        try:
+            geom_column = self.table.geom_column()
+            version = self.table.schema_version()
+            self.pk = self.table.pk()
+            for i, tile in enumerate(self.tiles):
+                if self.isCanceled():
+                    return False
+                self.results[tile] = fetch_tile_cached(
+                    self.table, self.where, geom_column, tile, version
+                )
+                self.setProgress((i + 1) / len(self.tiles) * 100)
+            return True
+        except Exception:
+            self.exception = traceback.format_exc()
+            error(self.exception)
+            return False
+
+
+class LiveLayer(QObject):
+    """
+    A read-only layer that only contains the features of a table that
+    intersect the current canvas extent. Features are requested per web
+    mercator tile, so panning back to an area that was already visited
+    doesn't fetch it again, and tiles are kept in the tile cache across
+    sessions
+    """
+
+    _live_layers = []
+
+    def __init__(self, table, where="TRUE"):
+        super().__init__()
+        self.table = table
+        self.where = where
+        self.layer = None
+        self._fields = None
+        self._geom_field = None
+        self._converters = None
+        self._loaded = {}
+        self._seen = set()
+        self._task = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(UPDATE_DELAY)
+        self._timer.timeout.connect(self._update)
+
+    def start(self):
+        LiveLayer._live_layers.append(self)
+        iface.mapCanvas().extentsChanged.connect(self._timer.start)
+        self._update()
+
+    def stop(self):
+        iface.mapCanvas().extentsChanged.disconnect(self._timer.start)
+        self._timer.stop()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self in LiveLayer._live_layers:
+            LiveLayer._live_layers.remove(self)
+
+    def _visible_tiles(self):
+        canvas = iface.mapCanvas()
+        transform = QgsCoordinateTransform(
+            canvas.mapSettings().destinationCrs(),
+            QgsCoordinateReferenceSystem("EPSG:4326"),
+            QgsProject.instance(),
+        )
+        extent = transform.transformBoundingBox(canvas.extent())
+        extent = extent.intersect(QgsRectangle(-180, -MAX_LATITUDE, 180, MAX_LATITUDE))
+        if extent.isEmpty():
+            return []
+        z = zoom_for_extent(extent, MAX_VISIBLE_TILES)
+        return tiles_for_extent(extent, z)
+
+    def _is_covered(self, tile):
+        # a tile is also covered if one of its parents was loaded without
+        # hitting the feature limit
+        return tile in self._loaded or any(
+            self._loaded.get(parent) for parent in parent_tiles(*tile)
+        )
+
+    def _update(self):
+        missing = [tile for tile in self._visible_tiles() if not self._is_covered(tile)]
+        if not missing:
+            return
+        if self._task is not None:
+            self._task.cancel()
+        task = FetchTilesTask(self.table, self.where, missing)
+        task.taskCompleted.connect(lambda: self._tiles_fetched(task))
+        task.taskTerminated.connect(lambda: self._tiles_fetched(task))
+        self._task = task
+        TASK_SCHEDULER.add_task(
+            task, self.table.schema.database.connection.name, TaskPriority.Interactive
+        )
+
+    def _tiles_fetched(self, task):
+        if task is self._task:
+            self._task = None
+        if self not in LiveLayer._live_layers:
+            return
+        features = []
+        keys = set()
+        loaded = {}
+        for tile, data in task.results.items():
+            rows = data.get("rows", [])
+            if rows and self.layer is None and not self._create_layer(data):
+                # the rows are dropped, so the tile is fetched again later
+                continue
+            loaded[tile] = len(rows) < MAX_FEATURES_PER_TILE
+            for row in rows:
+                key = row.get(task.pk) if task.pk else json.dumps(row, default=str)
+                if key in self._seen or key in keys:
+                    continue
+                keys.add(key)
+                features.append(
+                    feature_from_row(
+                        row, self._fields, self._geom_field, self._converters
+                    )
+                )
+        if features:
+            if not self.layer.dataProvider().addFeatures(features):
+                error(f"Could not add features to {self.layer.name()}")
+                return
+            self.layer.updateExtents()
+            self.layer.triggerRepaint()
+        # tiles only count as loaded once their rows are in the layer
+        self._seen.update(keys)
+        self._loaded.update(loaded)
+        if self.layer is None and self._task is None:
+            # nothing to show, so the canvas isn't followed anymore
+            self.stop()
+            iface.messageBar().pushMessage(
+                f"Could not load {self.table.name}"
+                if task.exception is not None
+                else f"{self.table.name} has no features in the current extent",
+                level=Qgis.Warning,
+                duration=5,
+            )
+
+    def _create_layer(self, data):
+        provider_type = self.table.schema.database.connection.provider_type
+        # the table info was fetched by the task, so this doesn't block
+        self._fields, self._geom_field = fields_from_schema(
+            data.get("schema", []), provider_type, self.table.columns()
+        )
+        self._converters = converters_for_fields(self._fields)
+        geom_type = geometry_type_from_rows(data.get("rows", []), self._geom_field)
+        if geom_type is None:
+            return False
+        self.layer = memory_layer(f"{self.table.name} (live)", geom_type, self._fields)
+        self.layer.setReadOnly(True)
+        self.layer.willBeDeleted.connect(self.stop)
+        QgsProject.instance().addMapLayer(self.layer)
+        return True
+
+
+def add_live_layer(table, where="TRUE"):
+    live_layer = LiveLayer(table, where)
+    live_layer.start()
+    return live_layer
@@ -0,0 +1,93 @@
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from carto.core.logging import info
+from carto.core.metrics import format_bytes
+from carto.core.utils import setting, MEMORY_BUDGET
+
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 10000
+# share of the free budget that a single page of rows can take
+PAGE_SHARE = 0.1
+# rows take this many times more memory once parsed and turned into
+# features than in the response body
+PARSED_ROW_FACTOR = 4
+
+
+def rss():
+    """
+    Returns the resident memory of the process in bytes, or None if it
+    can't be measured
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def max_workers(workers):
+    """
+    Returns how many downloads or imports can run at once. With a memory
+    budget they run one at a time, since the budget is measured on the
+    memory of the whole process
+    """
+    return 1 if setting(MEMORY_BUDGET) else workers
+
+
+class MemoryBudget:
+    """
+    Tracks the memory that a task uses over what the process used when it
+    started, against the budget set in the plugin settings. Without a
+    budget, or if memory can't be measured, it only tracks the peak
+    """
+
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = (setting(MEMORY_BUDGET) or 0) * 1024 ** 2
+        self.budget = budget
+        self.start = rss()
+        self.peak = self.start
+
+    @property
+    def enabled(self):
+        return bool(self.budget) and self.start is not None
+
+    def used(self):
+        current = rss()
+        if current is None:
+            return 0
+        self.peak = max(self.peak, current)
+        return current - self.start
+
+    def exceeded(self):
+        return self.enabled and self.used() > self.budget
+
+    def page_size(self, row_size, default):
+        """
+        Returns the number of rows to request in a page, for rows of the
+        given size in the response body, so a page takes a small share of
+        the budget that is left
+        """
+        if not self.enabled or not row_size:
+            return default
+        available = max(self.budget - self.used(), 0) * PAGE_SHARE
+        size = available / (row_size * PARSED_ROW_FACTOR)
+        return int(min(MAX_PAGE_SIZE, max(MIN_PAGE_SIZE, size)))
+
+    def report(self, name):
+        self.used()
+        if self.start is None:
+            return
+        budget = f", budget {format_bytes(self.budget)}" if self.enabled else ""
+        info(
+            f"{name}: peak memory {format_bytes(self.peak)}, "
+            f"{format_bytes(self.peak - self.start)} over the start of the task"
+            f"{budget}"
+        )
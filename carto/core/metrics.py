@@ -0,0 +1,267 @@
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from carto.core.logging import info, error
+from carto.core.utils import setting, REQUEST_TRACE_FILE
+
+MAX_RECORDS = 1000
+MAX_TASKS = 100
+
+
+def sql_fingerprint(sql):
+    """
+    Returns the SQL with comments, literals and extra whitespace removed,
+    so all the executions of the same statement share a fingerprint
+    """
+    sql = re.sub(r"--[^\n]*", "", sql)
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def connection_from_url(url):
+    """
+    Returns the connection that a request is made for, or "workspace" for
+    requests to the workspace API
+    """
+    match = re.search(r"/v3/(?:sql|maps)/([^/]+)/", url)
+    return match.group(1) if match is not None else "workspace"
+
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return f"{seconds * 1000:.0f} ms"
+    return f"{seconds:.1f} s"
+
+
+class RequestLog:
+    """
+    Keeps a record of the requests made to the CARTO API, with their sizes
+    and times, in a ring buffer of the last requests. Records can also be
+    appended to a JSONL trace file, set in the plugin settings.
+
+    Requests made while a task scope is active in the current thread are
+    also collected for that scope, and a summary is logged when it ends.
+    The summaries of the last tasks are kept as well.
+    """
+
+    def __init__(self, max_records=MAX_RECORDS):
+        self._records = deque(maxlen=max_records)
+        self._tasks = deque(maxlen=MAX_TASKS)
+        self._running = {}
+        self._in_flight = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def tasks(self):
+        """
+        Returns the stats of the running tasks, followed by the ones of the
+        last finished tasks
+        """
+        with self._lock:
+            running = [
+                self._task_stats(name, start, scope)
+                for name, start, scope in self._running.values()
+            ]
+            return running + list(reversed(self._tasks))
+
+    def in_flight(self):
+        with self._lock:
+            return {key: count for key, count in self._in_flight.items() if count}
+
+    @contextmanager
+    def request(self, url):
+        """
+        Counts a request as in flight, for the connection it is made for,
+        while the context is active
+        """
+        key = connection_from_url(url)
+        with self._lock:
+            self._in_flight[key] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[key] -= 1
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._tasks.clear()
+
+    def record(self, response, start, sql=None, parse_time=None, bytes_in=None):
+        """
+        Records a request. bytes_in must be passed for streamed responses,
+        whose content has been consumed
+        """
+        request = response.request
+        body = request.body or b""
+        retries = getattr(getattr(response.raw, "retries", None), "history", None)
+        record = {
+            "time": time.time(),
+            "endpoint": response.url.split("?")[0],
+            "method": request.method,
+            "status": response.status_code,
+            "bytes_in": len(response.content) if bytes_in is None else bytes_in,
+            "bytes_out": len(request.url) + len(body),
+            # time until the response headers are received
+            "server_time": response.elapsed.total_seconds(),
+            "parse_time": parse_time,
+            "total_time": time.perf_counter() - start,
+            "retries": len(retries or []),
+        }
+        if sql is not None:
+            fingerprint = sql_fingerprint(sql)
+            record["sql"] = fingerprint[:200]
+            record["fingerprint"] = hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+        with self._lock:
+            self._records.append(record)
+            self._trace(record)
+        scope = getattr(self._local, "scope", None)
+        if scope is not None:
+            scope.append(record)
+        return record
+
+    def _trace(self, record):
+        path = setting(REQUEST_TRACE_FILE)
+        if not path:
+            return
+        try:
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            error(f"Could not write request trace to {path}: {e}")
+
+    @contextmanager
+    def task_scope(self, name):
+        """
+        Collects the requests made in the current thread while the scope is
+        active, and logs a summary of them when it ends
+        """
+        previous = getattr(self._local, "scope", None)
+        scope = []
+        self._local.scope = scope
+        start = time.time()
+        with self._lock:
+            self._running[id(scope)] = (name, start, scope)
+        try:
+            yield scope
+        finally:
+            self._local.scope = previous
+            with self._lock:
+                del self._running[id(scope)]
+                stats = self._task_stats(name, start, scope)
+                stats["running"] = False
+                self._tasks.append(stats)
+            if scope:
+                info(f"{name}: {self.summary(scope)}")
+
+    @staticmethod
+    def _task_stats(name, start, records):
+        records = list(records)
+        return {
+            "name": name,
+            "running": True,
+            "start": start,
+            "duration": time.time() - start,
+            "requests": len(records),
+            "bytes": sum(r["bytes_in"] + r["bytes_out"] for r in records),
+            "retries": sum(r["retries"] for r in records),
+            "errors": sum(1 for r in records if r["status"] >= 400),
+        }
+
+    def bind(self, func):
+        """
+        Returns a function that runs func with the task scope of the current
+        thread, so requests made from worker threads count for the task
+        """
+        scope = getattr(self._local, "scope", None)
+
+        def wrapper(*args, **kwargs):
+            previous = getattr(self._local, "scope", None)
+            self._local.scope = scope
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.scope = previous
+
+        return wrapper
+
+    @staticmethod
+    def summary(records):
+        times = [r["total_time"] for r in records]
+        size = sum(r["bytes_in"] + r["bytes_out"] for r in records)
+        return (
+            f"{len(records)} requests, {format_bytes(size)}, "
+            f"p50 {format_seconds(_percentile(times, 50))}, "
+            f"p99 {format_seconds(_percentile(times, 99))}"
+        )
+
+
+class CacheStats:
+    """
+    Counts hits and misses of the caches used by the plugin
+    """
+
+    def __init__(self):
+        self._hits = Counter()
+        self._misses = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, cache, hit):
+        with self._lock:
+            if hit:
+                self._hits[cache] += 1
+            else:
+                self._misses[cache] += 1
+
+    def stats(self):
+        with self._lock:
+            caches = sorted(set(self._hits) | set(self._misses))
+            return {cache: (self._hits[cache], self._misses[cache]) for cache in caches}
+
+    def clear(self):
+        with self._lock:
+            self._hits.clear()
+            self._misses.clear()
+
+
+REQUEST_LOG = RequestLog()
+CACHE_STATS = CacheStats()
+
+
+def log_task_requests(run):
+    """
+    Decorator for the run method of a QgsTask, that logs a summary of the
+    requests made by the task when it ends
+    """
+
+    @functools.wraps(run)
+    def wrapper(task):
+        with REQUEST_LOG.task_scope(task.description()):
+            return run(task)
+
+    return wrapper
@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+
+import requests
+
+from carto.core.api import CARTO_API
+from carto.core.logging import debug
+from carto.core.metrics import CACHE_STATS
+from carto.core.utils import quote_for_provider, setting, setSetting
+
+WRITE_PERMISSIONS_SETTING = "writePermissions"
+
+PERMISSION_CACHE_TTL = 24 * 60 * 60
+
+
+def _privilege_query(provider_type, schemaid):
+    if provider_type == "postgres":
+        return f"SELECT has_schema_privilege('{schemaid}', 'CREATE') AS can_write;"
+    elif provider_type == "redshift":
+        return (
+            "SELECT has_schema_privilege("
+            f"current_user, '{schemaid}', 'CREATE') AS can_write;"
+        )
+    return None
+
+
+def _is_true(value):
+    if isinstance(value, str):
+        return value.lower() in ["true", "t", "1", "yes"]
+    return bool(value)
+
+
+class WritePermissions:
+    """
+    Tells whether the current user can create tables in a schema.
+
+    Privileges are read from the catalog for providers that expose them,
+    and otherwise probed by creating and dropping a test table. Results are
+    kept for PERMISSION_CACHE_TTL seconds and persisted in the QGIS settings,
+    so the probe runs at most once per schema in that period.
+    """
+
+    def __init__(self, ttl=PERMISSION_CACHE_TTL):
+        self.ttl = ttl
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def _entries(self):
+        if self._cache is None:
+            try:
+                self._cache = json.loads(setting(WRITE_PERMISSIONS_SETTING) or "{}")
+            except ValueError:
+                self._cache = {}
+        return self._cache
+
+    def _save(self):
+        now = time.time()
+        self._cache = {
+            key: entry
+            for key, entry in self._entries().items()
+            if now - entry["timestamp"] < self.ttl
+        }
+        setSetting(WRITE_PERMISSIONS_SETTING, json.dumps(self._cache))
+
+    def _key(self, schema):
+        return "/".join(
+            [
+                CARTO_API.user_email or "",
+                schema.database.connection.name,
+                schema.database.databaseid,
+                schema.schemaid,
+            ]
+        )
+
+    def can_write(self, schema):
+        """
+        Returns whether the user can create tables in the schema, or None
+        if it couldn't be checked
+        """
+        key = self._key(schema)
+        with self._lock:
+            entry = self._entries().get(key)
+        hit = entry is not None and time.time() - entry["timestamp"] < self.ttl
+        CACHE_STATS.count("permissions", hit)
+        if hit:
+            return entry["can_write"]
+        try:
+            can_write = self._check(schema)
+        except Exception as e:
+            # the warehouse couldn't be reached, so we don't know the answer
+            # yet. Don't remember it, to check again next time
+            debug(f"Could not check write permission for {schema.name}: {e}")
+            return None
+        with self._lock:
+            self._entries()[key] = {"can_write": can_write, "timestamp": time.time()}
+            self._save()
+        return can_write
+
+    def invalidate(self, schema):
+        with self._lock:
+            self._entries().pop(self._key(schema), None)
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+            self._save()
+
+    def _check(self, schema):
+        provider_type = schema.database.connection.provider_type
+        query = _privilege_query(provider_type, schema.schemaid)
+        if query is not None:
+            try:
+                rows = CARTO_API.execute_query(schema.database.connection.name, query)[
+                    "rows"
+                ]
+                return _is_true(list(rows[0].values())[0])
+            except Exception as e:
+                debug(f"Could not read privileges for {schema.name}: {e}")
+        return self._probe(schema)
+
+    def _probe(self, schema):
+        fqn = quote_for_provider(
+            f"{schema.database.databaseid}.{schema.schemaid}.__qgis_test_table",
+            schema.database.connection.provider_type,
+        )
+        sql = [
+            f"DROP TABLE IF EXISTS {fqn};",
+            f"CREATE TABLE {fqn} AS (SELECT 1 AS id);",
+            f"DROP TABLE {fqn};",
+        ]
+        try:
+            for statement in sql:
+                CARTO_API.execute_query(schema.database.connection.name, statement)
+            return True
+        except requests.exceptions.HTTPError as e:
+            # server errors don't tell whether the user can write
+            if e.response is not None and e.response.status_code >= 500:
+                raise
+            return False
+
+
+WRITE_PERMISSIONS = WritePermissions()
@@ -0,0 +1,69 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from carto.core.logging import debug
+from carto.core.utils import setting, PREFETCH_CATALOG
+
+MAX_PREFETCH_WORKERS = 2
+MAX_PREFETCH_ITEMS = 10
+
+
+class CatalogPrefetcher:
+    """
+    Warms the catalog level below the one that was just expanded, so the
+    next expansion is answered from the cache instead of the network
+    """
+
+    def __init__(self, max_workers=MAX_PREFETCH_WORKERS, max_items=MAX_PREFETCH_ITEMS):
+        self.max_workers = max_workers
+        self.max_items = max_items
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def is_enabled(self):
+        return setting(PREFETCH_CATALOG)
+
+    def prefetch(self, catalog_objects, loaded, fetch):
+        """
+        Calls fetch on the first catalog objects for which loaded returns
+        False, using a bounded pool of worker threads
+        """
+        if not self.is_enabled():
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="carto-prefetch",
+                )
+            for catalog_object in catalog_objects[: self.max_items]:
+                if catalog_object in self._pending or loaded(catalog_object):
+                    continue
+                future = self._executor.submit(self._warm, catalog_object, fetch)
+                self._pending[catalog_object] = future
+
+    def _warm(self, catalog_object, fetch):
+        try:
+            fetch(catalog_object)
+        except Exception as e:
+            debug(f"Could not prefetch {catalog_object.name}: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(catalog_object, None)
+
+    def cancel_all(self):
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+
+    def shutdown(self):
+        self.cancel_all()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+CATALOG_PREFETCHER = CatalogPrefetcher()
@@ -0,0 +1,76 @@
+import cProfile
+import functools
+import itertools
+import os
+import pstats
+import re
+import threading
+import time
+
+from qgis.core import QgsApplication
+
+from carto.core.logging import info
+from carto.core.utils import setting, PROFILE_TASKS
+
+TOP_HOTSPOTS = 15
+
+# makes the names of profiles saved in the same second unique
+_profile_counter = itertools.count()
+
+
+def profiles_folder():
+    return os.path.join(
+        os.path.dirname(QgsApplication.qgisUserDatabaseFilePath()), "cartoprofiles"
+    )
+
+
+def hotspots(profiler, top=TOP_HOTSPOTS):
+    """
+    Returns a summary of the functions where most time was spent, excluding
+    the time spent in the functions they call
+    """
+    stats = pstats.Stats(profiler).stats
+    entries = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+    lines = [f"{'tottime':>9} {'cumtime':>9} {'calls':>8}  function"]
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in entries[:top]:
+        location = f"{os.path.basename(filename)}:{line}" if line else filename
+        lines.append(f"{tottime:9.3f} {cumtime:9.3f} {calls:8d}  {location}({name})")
+    return "\n".join(lines)
+
+
+def profiled(func):
+    """
+    Runs the decorated function with cProfile when profiling is enabled in
+    the plugin settings. The profile is saved to the profiles folder, to be
+    opened with pstats or snakeviz, and its hotspots are logged. Only the
+    calling thread is profiled. Since Python 3.12 a single profiler can be
+    active at a time, so tasks that start while another one is profiled
+    run without profiling
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not setting(PROFILE_TASKS):
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            info(f"Not profiling {func.__qualname__}, another task is profiled")
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            name = re.sub(r"[^\w.]", "_", func.__qualname__)
+            folder = profiles_folder()
+            os.makedirs(folder, exist_ok=True)
+            suffix = (
+                f"{time.strftime('%Y%m%d_%H%M%S')}_{threading.get_ident()}"
+                f"_{next(_profile_counter)}"
+            )
+            path = os.path.join(folder, f"{name}_{suffix}.prof")
+            profiler.dump_stats(path)
+            info(f"Profile of {func.__qualname__} saved to {path}\n{hotspots(profiler)}")
+
+    return wrapper
@@ -0,0 +1,121 @@
+from collections import deque
+
+from qgis.core import QgsApplication
+from qgis.PyQt.QtCore import QObject
+
+from carto.core.enums import TaskPriority
+from carto.core.memory import max_workers
+
+MAX_TASKS_PER_CONNECTION = 3
+MAX_TASKS = 6
+# slots that bulk tasks can't take, so browsing and live layers stay
+# responsive while large downloads and imports are running
+RESERVED_TASKS_PER_CONNECTION = 1
+RESERVED_TASKS = 2
+
+
+class TaskScheduler(QObject):
+    """
+    Queues the tasks of the plugin before handing them to the QGIS task
+    manager, so that the number of tasks running against a connection and
+    in total is limited. Waiting tasks are started by priority, and tasks
+    with the same priority are shared among connections, starting first
+    the ones of the connection with fewer running tasks
+    """
+
+    def __init__(
+        self, max_tasks_per_connection=MAX_TASKS_PER_CONNECTION, max_tasks=MAX_TASKS
+    ):
+        super().__init__()
+        self.max_tasks_per_connection = max_tasks_per_connection
+        self.max_tasks = max_tasks
+        self._queues = {priority: deque() for priority in TaskPriority}
+        self._running = {}
+
+    def add_task(self, task, connection_name, priority=TaskPriority.Bulk):
+        """
+        Adds a task to be run when there is a free slot for it. Tasks that
+        are canceled before they start are removed from the queue. Returns
+        True if the task was started, or False if it is waiting
+        """
+        entry = (task, connection_name)
+        task.taskCompleted.connect(lambda: self._task_finished(entry))
+        task.taskTerminated.connect(lambda: self._task_finished(entry))
+        self._queues[priority].append(entry)
+        self._schedule()
+        return task in self._running
+
+    def _task_finished(self, entry):
+        task, _ = entry
+        if self._running.pop(task, None) is None:
+            for queue in self._queues.values():
+                if entry in queue:
+                    queue.remove(entry)
+        self._schedule()
+
+    def _running_for(self, connection_name):
+        return sum(1 for name, _ in self._running.values() if name == connection_name)
+
+    def _running_bulk(self):
+        return sum(
+            1 for _, priority in self._running.values() if priority == TaskPriority.Bulk
+        )
+
+    def _has_slot(self, connection_name, priority):
+        reserved = priority == TaskPriority.Bulk
+        # with a memory budget, downloads and imports run one at a time
+        if reserved and self._running_bulk() >= max_workers(self.max_tasks):
+            return False
+        max_tasks = self.max_tasks - (RESERVED_TASKS if reserved else 0)
+        max_per_connection = self.max_tasks_per_connection - (
+            RESERVED_TASKS_PER_CONNECTION if reserved else 0
+        )
+        return (
+            len(self._running) < max_tasks
+            and self._running_for(connection_name) < max(1, max_per_connection)
+        )
+
+    def _next_task(self):
+        for priority, queue in self._queues.items():
+            candidates = [
+                entry for entry in queue if self._has_slot(entry[1], priority)
+            ]
+            if candidates:
+                # the first waiting task of the least busy connection
+                entry = min(candidates, key=lambda e: self._running_for(e[1]))
+                queue.remove(entry)
+                return entry, priority
+        return None, None
+
+    def _schedule(self):
+        while True:
+            entry, priority = self._next_task()
+            if entry is None:
+                return
+            task, connection_name = entry
+            self._running[task] = (connection_name, priority)
+            QgsApplication.taskManager().addTask(task)
+
+    def stats(self):
+        """
+        Returns the number of running and waiting tasks of each connection
+        """
+        stats = {}
+        for connection_name, _ in self._running.values():
+            running, waiting = stats.get(connection_name, (0, 0))
+            stats[connection_name] = (running + 1, waiting)
+        for queue in self._queues.values():
+            for _, connection_name in queue:
+                running, waiting = stats.get(connection_name, (0, 0))
+                stats[connection_name] = (running, waiting + 1)
+        return stats
+
+    def cancel_waiting(self):
+        waiting = [task for queue in self._queues.values() for task, _ in queue]
+        for queue in self._queues.values():
+            queue.clear()
+        for task in waiting:
+            task.cancel()
+
+
+TASK_SCHEDULER = TaskScheduler()
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from carto.core.layers import layers_folder
+from carto.core.metrics import CACHE_STATS
+from carto.core.utils import setting, TILE_CACHE_SIZE, TILE_CACHE_TTL
+
+DEFAULT_TILE_CACHE_SIZE = 256
+# minutes
+DEFAULT_TILE_CACHE_TTL = 60
+
+
+class TileCache:
+    """
+    Stores the rows fetched for a tile of a table in a SQLite file, so
+    requests for an area that was already fetched don't hit the warehouse.
+
+    Entries are keyed by table, filter, tile and schema version, and are
+    stored as compressed JSON with geometries already converted to WKB.
+    Results of other small queries of a table, like density previews, are
+    cached as well, keyed by their query. When the cache grows over its
+    size cap, the least recently used entries are evicted. Entries expire
+    after the time to live set in the plugin settings, and the entries of
+    a table are dropped when it is changed or downloaded again, as the
+    cache can't tell when its rows change.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @property
+    def path(self):
+        return self._path or os.path.join(layers_folder(), "tilecache.sqlite")
+
+    def max_size(self):
+        size = setting(TILE_CACHE_SIZE)
+        if size is None:
+            size = DEFAULT_TILE_CACHE_SIZE
+        return size * 1024 * 1024
+
+    def ttl(self):
+        """
+        Returns the seconds that entries are valid for, or None if they
+        don't expire
+        """
+        ttl = setting(TILE_CACHE_TTL)
+        if ttl is None:
+            ttl = DEFAULT_TILE_CACHE_TTL
+        return ttl * 60 if ttl > 0 else None
+
+    def is_enabled(self):
+        return self.max_size() > 0
+
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            columns = [
+                row[1] for row in connection.execute("PRAGMA table_info(tiles)")
+            ]
+            if columns and "table_id" not in columns:
+                # entries of earlier versions can't be expired or dropped
+                # per table
+                connection.execute("DROP TABLE tiles")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS tiles (
+                    key TEXT PRIMARY KEY,
+                    table_id TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles(last_access)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS tiles_table_id ON tiles(table_id)"
+            )
+            connection.commit()
+            self._initialized = True
+        return connection
+
+    @staticmethod
+    def table_id(table):
+        return TileCache.table_id_for(
+            table.schema.database.connection.name,
+            table.schema.database.databaseid,
+            table.schema.schemaid,
+            table.tableid,
+        )
+
+    @staticmethod
+    def table_id_for(connection_name, databaseid, schemaid, tableid):
+        return "/".join([connection_name, databaseid, schemaid, tableid])
+
+    @staticmethod
+    def key(table_id, where, tile, version):
+        z, x, y = tile
+        value = json.dumps([table_id, where, z, x, y, version])
+        return hashlib.sha1(value.encode()).hexdigest()
+
+    @staticmethod
+    def query_key(table_id, query, version):
+        value = json.dumps([table_id, query, version])
+        return hashlib.sha1(value.encode()).hexdigest()
+
+    def get(self, key):
+        if not self.is_enabled():
+            return None
+        with self._lock:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    "SELECT data, created FROM tiles WHERE key = ?", (key,)
+                ).fetchone()
+                ttl = self.ttl()
+                if row is not None and ttl is not None and time.time() - row[1] > ttl:
+                    connection.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                    connection.commit()
+                    row = None
+                CACHE_STATS.count("tiles", row is not None)
+                if row is None:
+                    return None
+                connection.execute(
+                    "UPDATE tiles SET last_access = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                connection.commit()
+            finally:
+                connection.close()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, table_id, data):
+        if not self.is_enabled():
+            return
+        blob = zlib.compress(json.dumps(data, default=str).encode())
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, table_id, blob, len(blob), now, now),
+                )
+                self._evict(connection)
+                connection.commit()
+            finally:
+                connection.close()
+
+    def _evict(self, connection):
+        max_size = self.max_size()
+        total = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tiles"
+        ).fetchone()[0]
+        if total <= max_size:
+            return
+        # free some extra room, so we don't evict again on the next insert
+        to_free = total - max_size * 0.9
+        for key, size in connection.execute(
+            "SELECT key, size FROM tiles ORDER BY last_access"
+        ).fetchall():
+            if to_free <= 0:
+                break
+            connection.execute("DELETE FROM tiles WHERE key = ?", (key,))
+            to_free -= size
+
+    def invalidate(self, table_id):
+        """
+        Drops the entries of a table, once its rows are known to have
+        changed
+        """
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("DELETE FROM tiles WHERE table_id = ?", (table_id,))
+                connection.commit()
+            finally:
+                connection.close()
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute("DELETE FROM tiles")
+                connection.commit()
+                connection.execute("VACUUM")
+            finally:
+                connection.close()
+
+
+TILE_CACHE = TileCache()
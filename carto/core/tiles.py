@@ -0,0 +1,63 @@
+import math
+
+from qgis.core import QgsRectangle
+
+MAX_LATITUDE = 85.0511287798
+MAX_ZOOM = 18
+
+
+def _clamp(value, minimum, maximum):
+    return max(minimum, min(maximum, value))
+
+
+def tile_for_point(lon, lat, z):
+    n = 2**z
+    lat = math.radians(_clamp(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)
+    return _clamp(x, 0, n - 1), _clamp(y, 0, n - 1)
+
+
+def tile_bounds(z, x, y):
+    """
+    Returns the EPSG:4326 rectangle covered by a web mercator tile
+    """
+    n = 2**z
+
+    def _lat(ytile):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ytile / n))))
+
+    return QgsRectangle(
+        x / n * 360.0 - 180.0, _lat(y + 1), (x + 1) / n * 360.0 - 180.0, _lat(y)
+    )
+
+
+def _tile_range(rectangle4326, z):
+    xmin, ymax = tile_for_point(rectangle4326.xMinimum(), rectangle4326.yMinimum(), z)
+    xmax, ymin = tile_for_point(rectangle4326.xMaximum(), rectangle4326.yMaximum(), z)
+    return xmin, ymin, xmax, ymax
+
+
+def tiles_for_extent(rectangle4326, z):
+    xmin, ymin, xmax, ymax = _tile_range(rectangle4326, z)
+    return [(z, x, y) for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+
+
+def zoom_for_extent(rectangle4326, max_tiles=16):
+    """
+    Returns the highest zoom level at which the extent is covered by at most
+    max_tiles tiles
+    """
+    zoom = 0
+    for z in range(MAX_ZOOM + 1):
+        xmin, ymin, xmax, ymax = _tile_range(rectangle4326, z)
+        if (xmax - xmin + 1) * (ymax - ymin + 1) > max_tiles:
+            break
+        zoom = z
+    return zoom
+
+
+def parent_tiles(z, x, y):
+    while z > 0:
+        z, x, y = z - 1, x // 2, y // 2
+        yield z, x, y
@@ -1,17 +1,31 @@
+import re
 import uuid
 import requests
 import shutil
 from carto.gui.utils import waitcursor
 
-from qgis.PyQt.QtCore import QSettings, QVariant
+from qgis.PyQt.QtCore import QSettings, QVariant, QDate, QTime, QDateTime, Qt
 from qgis.core import NULL, QgsMessageLog, Qgis, QgsAuthMethodConfig, QgsApplication
 
 NAMESPACE = "carto"
 TOKEN = "token"
 
+PREFETCH_CATALOG = "prefetchCatalog"
+TILE_CACHE_SIZE = "tileCacheSize"
+TILE_CACHE_TTL = "tileCacheTtl"
+REQUEST_TRACE_FILE = "requestTraceFile"
+PROFILE_TASKS = "profileTasks"
+MEMORY_BUDGET = "memoryBudget"
+
 MAX_ROWS = 1000000
 
-setting_types = {}
+setting_types = {
+    PREFETCH_CATALOG: bool,
+    TILE_CACHE_SIZE: int,
+    TILE_CACHE_TTL: int,
+    PROFILE_TASKS: bool,
+    MEMORY_BUDGET: int,
+}
 
 
 def setSetting(name, value):
@@ -22,6 +36,11 @@ def setting(name):
     v = QSettings().value(f"{NAMESPACE}/{name}", None)
     if setting_types.get(name, str) == bool:
         return str(v).lower() == str(True).lower()
+    elif setting_types.get(name, str) == int:
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
     else:
         return v
 
@@ -56,6 +75,132 @@ def quote_column_name_for_provider(value, provider_type):
         return value
 
 
+def spatial_filter_for_provider(provider_type, geom_column, rectangle4326):
+    wkt = rectangle4326.asWktPolygon()
+    if provider_type == "databricksRest":
+        return f"ST_INTERSECTS(ST_GEOMFROMWKB({geom_column}), ST_GEOMFROMTEXT('{wkt}'))"
+    elif provider_type in ["postgres", "redshift"]:
+        return f"""CASE
+            WHEN ST_SRID({geom_column}) = 0 THEN
+                ST_INTERSECTS(
+                    ST_SETSRID({geom_column}, 4326),
+                    ST_SETSRID(ST_GEOMFROMTEXT('{wkt}'), 4326)
+                )
+            ELSE
+                ST_INTERSECTS(
+                    ST_TRANSFORM({geom_column}, 4326),
+                    ST_SETSRID(ST_GEOMFROMTEXT('{wkt}'), 4326)
+                )
+            END"""
+    else:
+        return f"ST_INTERSECTS({geom_column}, ST_GEOGFROMTEXT('{wkt}'))"
+
+
+def centroid_coordinates_for_provider(provider_type, geom_column):
+    """
+    Returns the expressions for the EPSG:4326 longitude and latitude of the
+    centroid of the geometry column
+    """
+    if provider_type == "databricksRest":
+        centroid = f"ST_CENTROID(ST_GEOMFROMWKB({geom_column}))"
+    elif provider_type in ["postgres", "redshift"]:
+        centroid = f"""ST_CENTROID(CASE
+            WHEN ST_SRID({geom_column}) = 0 THEN ST_SETSRID({geom_column}, 4326)
+            ELSE ST_TRANSFORM({geom_column}, 4326)
+            END)"""
+    else:
+        centroid = f"ST_CENTROID({geom_column})"
+    return f"ST_X({centroid})", f"ST_Y({centroid})"
+
+
+METERS_PER_DEGREE = 111320
+
+
+# providers whose geometries can be in a CRS other than EPSG:4326
+PROVIDERS_WITH_SRID = ["postgres", "redshift"]
+
+
+def geometry_4326_for_provider(provider_type, geom_column):
+    """
+    Returns an expression for the geometry column in EPSG:4326, the CRS of
+    the layers that tables are downloaded to. Geometries without an SRID
+    are taken as EPSG:4326
+    """
+    if provider_type in PROVIDERS_WITH_SRID:
+        return f"""CASE
+            WHEN ST_SRID({geom_column}) IN (0, 4326) THEN {geom_column}
+            ELSE ST_TRANSFORM({geom_column}, 4326)
+            END"""
+    return geom_column
+
+
+def simplify_geometry_for_provider(provider_type, geom_column, tolerance):
+    """
+    Returns an expression that simplifies the geometry column server-side.
+    The tolerance is in meters, and converted to degrees for providers that
+    simplify planar geometries, which are assumed to be in EPSG:4326
+    """
+    degrees = tolerance / METERS_PER_DEGREE
+    if provider_type in ["bigquery", "snowflake"]:
+        return f"ST_SIMPLIFY({geom_column}, {tolerance})"
+    elif provider_type == "postgres":
+        return f"ST_SIMPLIFYPRESERVETOPOLOGY({geom_column}, {degrees})"
+    elif provider_type == "redshift":
+        return f"ST_SIMPLIFY({geom_column}, {degrees})"
+    elif provider_type == "databricksRest":
+        return f"ST_ASWKB(ST_SIMPLIFY(ST_GEOMFROMWKB({geom_column}), {degrees}))"
+    return geom_column
+
+
+def geometry_type_expression_for_provider(provider_type, geom_column):
+    """
+    Returns the expressions for the geometry type of the geometry column,
+    and for its SRID (None for providers that only store EPSG:4326
+    geographies)
+    """
+    if provider_type in ["postgres", "redshift"]:
+        return f"GEOMETRYTYPE({geom_column})", f"ST_SRID({geom_column})"
+    elif provider_type == "snowflake":
+        return f"ST_ASGEOJSON({geom_column}):type::STRING", None
+    elif provider_type == "databricksRest":
+        return f"ST_GEOMETRYTYPE(ST_GEOMFROMWKB({geom_column}))", None
+    return f"ST_GEOMETRYTYPE({geom_column})", None
+
+
+SAMPLE_BUCKETS = 1000000
+
+
+def sample_clause_for_provider(provider_type, percent, seed):
+    """
+    Returns the TABLESAMPLE clause that selects a reproducible sample of
+    the given percent of the rows of a table, or None if the provider
+    can't sample repeatably with a seed
+    """
+    if provider_type == "postgres":
+        return f"TABLESAMPLE BERNOULLI ({percent}) REPEATABLE ({seed})"
+    elif provider_type == "snowflake":
+        return f"SAMPLE BERNOULLI ({percent}) SEED ({seed})"
+    elif provider_type == "databricksRest":
+        return f"TABLESAMPLE ({percent} PERCENT) REPEATABLE ({seed})"
+    return None
+
+
+def sample_predicate_for_provider(provider_type, key_column, percent, seed):
+    """
+    Returns a predicate that keeps the given percent of the rows, based on
+    a seeded hash of the key column. Used for providers without a
+    repeatable TABLESAMPLE
+    """
+    threshold = int(percent / 100 * SAMPLE_BUCKETS)
+    if provider_type == "bigquery":
+        hashed = f"FARM_FINGERPRINT(CONCAT(CAST({key_column} AS STRING), '{seed}'))"
+    elif provider_type == "redshift":
+        hashed = f"FNV_HASH(CAST({key_column} AS VARCHAR), {seed})"
+    else:
+        hashed = f"HASH(CONCAT(CAST({key_column} AS STRING), '{seed}'))"
+    return f"ABS(MOD({hashed}, {SAMPLE_BUCKETS})) < {threshold}"
+
+
 def prepare_multipart_sql(statements, provider, fqn):
     joined = "\n".join(statements)
     if provider == "redshift":
@@ -151,7 +296,112 @@ def provider_data_type_from_qgis_type(qgis_type, provider):
     return db_type
 
 
-def prepare_geo_value_for_provider(provider_type, geom):
+# decimal types, which are integers if their scale is 0
+DECIMAL_TYPES = ["fixed", "number", "numeric", "decimal", "bignumeric"]
+# precision of the decimals that always fit in a 64 bit integer
+MAX_INT64_DIGITS = 18
+# providers whose integer types are all decimals of scale 0, so their
+# precision doesn't tell integers wider than 64 bits apart. Snowflake
+# declares INTEGER and BIGINT as NUMBER(38,0)
+INTEGER_DECIMAL_PROVIDERS = ["snowflake"]
+
+
+def _decimal_qgis_type(precision, scale, provider=None):
+    if scale is None or scale > 0:
+        # if the scale isn't known, the values might have decimals
+        return QVariant.Double
+    if (
+        provider not in INTEGER_DECIMAL_PROVIDERS
+        and precision is not None
+        and precision > MAX_INT64_DIGITS
+    ):
+        # kept as text, so integers declared wider than 64 bits aren't
+        # rounded
+        return QVariant.String
+    return QVariant.LongLong
+
+
+def qgis_type_from_provider_data_type(
+    data_type, provider=None, precision=None, scale=None
+):
+    """
+    Inverse of provider_data_type_from_qgis_type. Returns the QGIS type for a
+    column type, as reported in the schema of a query result or in the table
+    metadata, or "geometry" for the geometry column. Types that have no
+    QGIS equivalent are read as strings.
+
+    Decimals with a scale of 0 are read as integers, or as strings if they
+    are declared wider than 64 bits, and as doubles otherwise. Their
+    precision and scale are taken from the type, as in NUMBER(38,0), or can
+    be passed. In Snowflake, where integers are NUMBER(38,0), decimals of
+    scale 0 are always read as integers
+    """
+    type_mapping = {
+        None: {
+            "string": QVariant.String,
+            "text": QVariant.String,
+            "varchar": QVariant.String,
+            "char": QVariant.String,
+            "character varying": QVariant.String,
+            "character": QVariant.String,
+            "smallint": QVariant.Int,
+            "tinyint": QVariant.Int,
+            "int2": QVariant.Int,
+            "int4": QVariant.Int,
+            # some providers report any integer column as integer or int in
+            # the schema of results, so they are read as 64 bits
+            "integer": QVariant.LongLong,
+            "int": QVariant.LongLong,
+            "int8": QVariant.LongLong,
+            "int64": QVariant.LongLong,
+            "bigint": QVariant.LongLong,
+            "long": QVariant.LongLong,
+            "double": QVariant.Double,
+            "double precision": QVariant.Double,
+            "float": QVariant.Double,
+            "float4": QVariant.Double,
+            "float8": QVariant.Double,
+            "float64": QVariant.Double,
+            "real": QVariant.Double,
+            "boolean": QVariant.Bool,
+            "bool": QVariant.Bool,
+            "date": QVariant.Date,
+            "time": QVariant.Time,
+            "datetime": QVariant.DateTime,
+            "timestamp": QVariant.DateTime,
+            "timestamptz": QVariant.DateTime,
+            "timestamp with time zone": QVariant.DateTime,
+            "timestamp without time zone": QVariant.DateTime,
+            "geometry": "geometry",
+            "geography": "geometry",
+        },
+        "snowflake": {
+            "timestamp_ntz": QVariant.DateTime,
+            "timestamp_ltz": QVariant.DateTime,
+            "timestamp_tz": QVariant.DateTime,
+        },
+    }
+
+    match = re.match(r"\s*([^(]*?)\s*\(\s*(\d+)\s*(?:,\s*(\d+)\s*)?\)", data_type)
+    if match is not None:
+        data_type, type_precision, type_scale = match.groups()
+        precision = int(type_precision)
+        # a decimal declared without scale, as NUMERIC(10), has scale 0
+        scale = int(type_scale or 0)
+    data_type = data_type.lower().split("(")[0].strip()
+    if data_type in DECIMAL_TYPES:
+        return _decimal_qgis_type(precision, scale, provider)
+    qgis_type = type_mapping.get(provider, {}).get(data_type)
+    if qgis_type is None:
+        qgis_type = type_mapping[None].get(data_type, QVariant.String)
+    return qgis_type
+
+
+def prepare_geo_value_for_provider(provider_type, geom, srid=None):
+    """
+    Returns the SQL value for an EPSG:4326 geometry. If srid is passed, the
+    geometry is transformed to it, for tables in other CRSs
+    """
     if provider_type == "databricksRest":
         return f"'{geom.asWkt()}'"
     else:
@@ -161,9 +411,12 @@ def prepare_geo_value_for_provider(provider_type, geom):
         elif provider_type == "snowflake":
             return f"'{wkb}'"
         elif provider_type == "redshift":
-            return f"ST_GEOMFROMWKB('{wkb}')"
+            value = f"ST_GEOMFROMWKB('{wkb}')"
         else:
-            return f"ST_GEOMFROMWKB(DECODE('{wkb}', 'hex'))"
+            value = f"ST_GEOMFROMWKB(DECODE('{wkb}', 'hex'))"
+        if srid and srid != 4326:
+            return f"ST_TRANSFORM(ST_SETSRID({value}, 4326), {srid})"
+        return value
 
 
 def is_integer_num(n):
@@ -183,6 +436,10 @@ def prepare_num_string(n):
 def prepare_attribute_string(value, isNumeric):
     if value == NULL:
         return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (QDate, QTime, QDateTime)):
+        return f"'{value.toString(Qt.ISODate)}'"
     if isNumeric:
         return prepare_num_string(value)
     else:
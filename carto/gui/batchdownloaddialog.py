@@ -0,0 +1,44 @@
+import os
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtWidgets import QDialog, QListWidgetItem
+
+WIDGET, BASE = uic.loadUiType(
+    os.path.join(os.path.dirname(__file__), "batchdownloaddialog.ui")
+)
+
+
+class BatchDownloadDialog(BASE, WIDGET):
+    def __init__(self, tables, parent=None):
+        super(QDialog, self).__init__(parent)
+        self.setupUi(self)
+
+        self.tables = []
+        self._all_tables = tables
+
+        self.btnSelectAll.clicked.connect(lambda: self._set_checked(Qt.Checked))
+        self.btnSelectNone.clicked.connect(lambda: self._set_checked(Qt.Unchecked))
+        self.buttonBox.accepted.connect(self.okClicked)
+        self.buttonBox.rejected.connect(self.reject)
+
+        self.initGui()
+
+    def initGui(self):
+        for table in self._all_tables:
+            item = QListWidgetItem(table.name)
+            item.setCheckState(Qt.Unchecked)
+            self.listTables.addItem(item)
+
+    def _set_checked(self, state):
+        for i in range(self.listTables.count()):
+            self.listTables.item(i).setCheckState(state)
+
+    def okClicked(self):
+        self.tables = [
+            table
+            for i, table in enumerate(self._all_tables)
+            if self.listTables.item(i).checkState() == Qt.Checked
+        ]
+        if self.tables:
+            self.accept()
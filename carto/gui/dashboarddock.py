@@ -0,0 +1,115 @@
+import os
+import time
+
+from qgis.core import QgsApplication, QgsTask
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtCore import QTimer
+from qgis.PyQt.QtWidgets import QDockWidget, QTableWidgetItem
+
+from carto.core.metrics import (
+    REQUEST_LOG,
+    CACHE_STATS,
+    format_bytes,
+    format_seconds,
+)
+from carto.core.scheduler import TASK_SCHEDULER
+
+WIDGET, BASE = uic.loadUiType(
+    os.path.join(os.path.dirname(__file__), "dashboarddock.ui")
+)
+
+REFRESH_INTERVAL = 1000
+
+
+def _fill_table(table, rows):
+    table.setRowCount(len(rows))
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            table.setItem(i, j, QTableWidgetItem(str(value)))
+    table.resizeColumnsToContents()
+
+
+class DashboardDock(BASE, WIDGET):
+    """
+    Shows the requests, tasks and caches of the plugin, refreshed while the
+    dock is visible
+    """
+
+    def __init__(self, parent=None):
+        super(QDockWidget, self).__init__(parent)
+        self.setupUi(self)
+        self.setObjectName("CartoDashboardDock")
+
+        self.btnClear.clicked.connect(self.clear)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self._visibility_changed)
+
+    def _visibility_changed(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def clear(self):
+        REQUEST_LOG.clear()
+        CACHE_STATS.clear()
+        self.refresh()
+
+    def refresh(self):
+        records = REQUEST_LOG.records()
+        if records:
+            retries = sum(r["retries"] for r in records)
+            errors = sum(1 for r in records if r["status"] >= 400)
+            self.lblRequests.setText(
+                f"Last {REQUEST_LOG.summary(records)}. "
+                f"{retries} retries, {errors} errors"
+            )
+        else:
+            self.lblRequests.setText("No requests yet")
+        self.lblQueue.setText(self._queue_text())
+
+        _fill_table(
+            self.tableInFlight, sorted(REQUEST_LOG.in_flight().items())
+        )
+        _fill_table(self.tableTasks, [self._task_row(t) for t in REQUEST_LOG.tasks()])
+        _fill_table(
+            self.tableCaches,
+            [
+                (cache, hits, misses, f"{hits / (hits + misses):.0%}")
+                for cache, (hits, misses) in CACHE_STATS.stats().items()
+            ],
+        )
+
+    def _queue_text(self):
+        tasks = QgsApplication.taskManager().tasks()
+        queued = sum(1 for task in tasks if task.status() == QgsTask.Queued)
+        running = sum(1 for task in tasks if task.status() == QgsTask.Running)
+        text = f"Task manager: {running} running, {queued} queued"
+        for connection_name, (running, waiting) in sorted(
+            TASK_SCHEDULER.stats().items()
+        ):
+            text += f"\n{connection_name}: {running} running, {waiting} waiting"
+        return text
+
+    @staticmethod
+    def _task_row(task):
+        duration = task["duration"]
+        throughput = (
+            f"{format_bytes(task['bytes'] / duration)}/s" if duration > 0 else "-"
+        )
+        return (
+            task["name"],
+            "Running" if task["running"] else time.strftime(
+                "%H:%M:%S", time.localtime(task["start"] + duration)
+            ),
+            task["requests"],
+            format_bytes(task["bytes"]),
+            format_seconds(duration),
+            throughput,
+            task["retries"],
+        )
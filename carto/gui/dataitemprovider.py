@@ -1,32 +1,45 @@
 import sip
 from json2html import json2html
 from qgis.PyQt.QtGui import QIcon
-from qgis.PyQt.QtWidgets import QAction, QDialog
+from qgis.PyQt.QtWidgets import QAction, QDialog, QProgressBar
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
     QgsDataItemProvider,
     QgsDataCollectionItem,
     QgsDataItem,
     QgsDataProvider,
+    QgsErrorItem,
     QgsProject,
     Qgis,
     QgsVectorTileLayer,
     QgsMessageOutput,
-    QgsApplication,
     QgsMessageLog,
     QgsCoordinateTransform,
+    QgsDataSourceUri,
+    QgsGraduatedSymbolRenderer,
+    QgsStyle,
+    QgsRectangle,
 )
 from qgis.utils import iface
 from functools import partial
 
-from carto.core.connection import CARTO_CONNECTION
-from carto.core.api import CARTO_API
+from carto.core.connection import CARTO_CONNECTION, Database, Schema
+from carto.core.catalogloader import CATALOG_LOADER
+from carto.core.scheduler import TASK_SCHEDULER
+from carto.core.prefetcher import CATALOG_PREFETCHER
+from carto.core.api import CARTO_API, HAS_REQUEST_PREPROCESSOR
 from carto.core.layers import layer_metadata
+from carto.core.logging import error
 from carto.core.utils import MAX_ROWS
 from carto.gui.importdialog import ImportDialog
+from carto.gui.batchdownloaddialog import BatchDownloadDialog
 from carto.gui.downloadfilteredlayerdialog import DownloadFilteredLayerDialog
+from carto.gui.densitypreviewdialog import DensityPreviewDialog
 from carto.gui.authorization_manager import AUTHORIZATION_MANAGER
 from carto.core.downloadtabletask import DownloadTableTask
+from carto.core.batchdownloadtask import BatchDownloadTask
+from carto.core.densitypreviewtask import DensityPreviewTask
+from carto.core.livelayer import add_live_layer
 from carto.gui.utils import icon
 
 
@@ -41,6 +54,11 @@ postgresIcon = icon("postgres.svg")
 tableIcon = icon("table.svg")
 basemapIcon = icon("basemap.svg")
 
+try:
+    FAST_CAPABILITY = Qgis.BrowserItemCapability.Fast
+except AttributeError:
+    FAST_CAPABILITY = QgsDataItem.Fast
+
 
 class DataItemProvider(QgsDataItemProvider):
     def __init__(self):
@@ -111,6 +129,87 @@ class BasemapItem(QgsDataItem):
         QgsProject.instance().addMapLayer(layer)
 
 
+class LoadingItem(QgsDataItem):
+    def __init__(self, parent):
+        QgsDataItem.__init__(
+            self, QgsDataItem.Custom, parent, "Loading…", parent.path() + "/loading"
+        )
+        self.populate()
+
+
+class CatalogCollectionItem(QgsDataCollectionItem):
+    """
+    Base class for browser items whose children come from the CARTO catalog.
+    The catalog is fetched on a worker thread and a placeholder is shown
+    until the results arrive
+    """
+
+    def __init__(self, parent, name, path, catalog_object):
+        QgsDataCollectionItem.__init__(self, parent, name, path)
+        # Loading is done by the catalog loader, so QGIS can call
+        # createChildren in the GUI thread
+        self.setCapabilitiesV2(self.capabilities2() | FAST_CAPABILITY)
+        self.catalog_object = catalog_object
+        self._load_error = None
+
+    # Subclasses override the methods below. By default an item has
+    # nothing to load and no children
+
+    def catalog_loaded(self):
+        """
+        Returns whether the catalog objects of the children are loaded, so
+        they can be created without blocking
+        """
+        return True
+
+    def load_catalog(self):
+        """
+        Loads the catalog objects of the children. Called in a worker thread
+        """
+        return []
+
+    def children_from_catalog(self):
+        """
+        Creates the child items from the loaded catalog objects
+        """
+        return []
+
+    def connection_name(self):
+        """
+        Returns the name of the connection that loading runs against, which
+        the task scheduler uses to limit the tasks per connection
+        """
+        return None
+
+    def createChildren(self):
+        if self._load_error is not None:
+            error_item = QgsErrorItem(self, self._load_error, self.path() + "/error")
+            self._load_error = None
+            return [error_item]
+        if self.catalog_loaded():
+            return self.children_from_catalog()
+        CATALOG_LOADER.load(
+            self.catalog_object,
+            self.connection_name(),
+            f"Loading {self.name()}",
+            self.load_catalog,
+            self._catalog_loaded,
+        )
+        return [LoadingItem(self)]
+
+    def _catalog_loaded(self, result):
+        if sip.isdeleted(self):
+            return
+        if result is None:
+            self._load_error = f"Could not load the contents of {self.name()}"
+        super().refresh()
+
+    def refresh(self):
+        # whatever was being loaded for this item is stale now
+        CATALOG_LOADER.cancel(self.catalog_object)
+        super().refresh()
+
+
 class ConnectionsItem(QgsDataCollectionItem):
     def __init__(self, parent):
         QgsDataCollectionItem.__init__(self, parent, "Connections", "/Connections")
@@ -128,14 +227,20 @@ class ConnectionsItem(QgsDataCollectionItem):
 
     def refresh(self):
         self.depopulate()
+        CATALOG_LOADER.cancel_all()
+        CATALOG_PREFETCHER.cancel_all()
         CARTO_CONNECTION.clear_connections_cache()
         super().refresh()
 
 
-class ConnectionItem(QgsDataCollectionItem):
+class ConnectionItem(CatalogCollectionItem):
     def __init__(self, parent, connection):
-        QgsDataCollectionItem.__init__(
-            self, parent, connection.name, "/Carto/connection" + connection.name
+        CatalogCollectionItem.__init__(
+            self,
+            parent,
+            connection.name,
+            "/Carto/connection" + connection.name,
+            connection,
         )
         if connection.provider_type == "bigquery":
             self.setIcon(bigqueryIcon)
@@ -151,41 +256,70 @@ class ConnectionItem(QgsDataCollectionItem):
             self.setIcon(cartoIcon)
         self.connection = connection
 
-    def createChildren(self):
+    def catalog_loaded(self):
+        return self.connection.databases_loaded()
+
+    def load_catalog(self):
+        return self.connection.databases()
+
+    def connection_name(self):
+        return self.connection.name
+
+    def children_from_catalog(self):
         children = []
         databases = self.connection.databases()
         for database in databases:
             item = DatabaseItem(self, database)
             children.append(item)
+        CATALOG_PREFETCHER.prefetch(databases, Database.schemas_loaded, Database.schemas)
         return children
 
 
-class DatabaseItem(QgsDataCollectionItem):
+class DatabaseItem(CatalogCollectionItem):
     def __init__(self, parent, database):
-        QgsDataCollectionItem.__init__(
-            self, parent, database.name, "/Carto/database" + database.name
+        CatalogCollectionItem.__init__(
+            self, parent, database.name, "/Carto/database" + database.name, database
         )
         self.setIcon(databaseIcon)
         self.database = database
 
-    def createChildren(self):
+    def catalog_loaded(self):
+        return self.database.schemas_loaded()
+
+    def load_catalog(self):
+        return self.database.schemas()
+
+    def connection_name(self):
+        return self.database.connection.name
+
+    def children_from_catalog(self):
         children = []
         schemas = self.database.schemas()
         for schema in schemas:
             item = SchemaItem(self, schema)
             children.append(item)
+        CATALOG_PREFETCHER.prefetch(schemas, Schema.tables_loaded, Schema.tables)
         return children
 
 
-class SchemaItem(QgsDataCollectionItem):
+class SchemaItem(CatalogCollectionItem):
     def __init__(self, parent, schema):
-        QgsDataCollectionItem.__init__(
-            self, parent, schema.name, "/Carto/schema" + schema.name
+        CatalogCollectionItem.__init__(
+            self, parent, schema.name, "/Carto/schema" + schema.name, schema
         )
         self.setIcon(schemaIcon)
         self.schema = schema
 
-    def createChildren(self):
+    def catalog_loaded(self):
+        return self.schema.tables_loaded()
+
+    def load_catalog(self):
+        return self.schema.tables()
+
+    def connection_name(self):
+        return self.schema.database.connection.name
+
+    def children_from_catalog(self):
         children = []
         tables = self.schema.tables()
         for table in tables:
@@ -201,8 +335,70 @@ class SchemaItem(QgsDataCollectionItem):
         import_action.triggered.connect(self.import_layer)
         actions.append(import_action)
 
+        download_action = QAction(QIcon(), "Download Tables...", parent)
+        download_action.triggered.connect(self.download_tables)
+        actions.append(download_action)
+
         return actions
 
+    def download_tables(self):
+        dialog = BatchDownloadDialog(self.schema.tables(), iface.mainWindow())
+        if dialog.exec_() != QDialog.Accepted:
+            return
+
+        task = BatchDownloadTask(self.schema, dialog.tables)
+
+        # the message shows the total progress in its bar, and the progress
+        # of each table in its text
+        message = iface.messageBar().createMessage("CARTO", task.description())
+        progress_bar = QProgressBar(message)
+        progress_bar.setMaximum(100)
+        message.layout().addWidget(progress_bar)
+        iface.messageBar().pushWidget(message, Qgis.Info)
+        table_progress = {}
+
+        def _progress_changed(progress):
+            if not sip.isdeleted(progress_bar):
+                progress_bar.setValue(int(progress))
+
+        def _table_progress_changed(name, progress):
+            table_progress[name] = progress
+            if not sip.isdeleted(message):
+                message.setText(
+                    ", ".join(f"{n} {p:.0f}%" for n, p in table_progress.items())
+                )
+
+        task.progressChanged.connect(_progress_changed)
+        task.table_progress_changed.connect(_table_progress_changed)
+        task.taskCompleted.connect(partial(self._tables_downloaded, task, message))
+        task.taskTerminated.connect(partial(self._tables_downloaded, task, message))
+
+        self.schema.tasks.append(task)
+
+        TASK_SCHEDULER.add_task(task, self.schema.database.connection.name)
+
+    def _tables_downloaded(self, task, message):
+        self.schema.tasks.remove(task)
+        if not sip.isdeleted(message):
+            iface.messageBar().popWidget(message)
+        for layer in task.layers:
+            QgsProject.instance().addMapLayer(layer)
+        if task.failed or task.exception is not None or task.isCanceled():
+            failed = ", ".join(task.failed)
+            iface.messageBar().pushMessage(
+                "Download of tables failed or was canceled"
+                + (f" ({failed})" if failed else ""),
+                level=Qgis.Warning,
+                duration=5,
+            )
+        elif task.layers and not self.schema.can_write():
+            iface.messageBar().pushMessage(
+                "Read-only",
+                "No permission to write. Local changes will not be saved to the original tables",
+                level=Qgis.Warning,
+                duration=10,
+            )
+
     def import_layer(self):
         dialog = ImportDialog(
             self.schema.database.connection,
@@ -243,12 +439,33 @@ class TableItem(QgsDataItem):
         add_layer_action.setEnabled(self.table.size < MAX_TABLE_SIZE)
         actions.append(add_layer_action)
 
+        add_tiles_action = QAction(QIcon(), "Add Layer as Vector Tiles", parent)
+        add_tiles_action.setToolTip(
+            "Render the table from tiles generated by CARTO, without downloading it"
+            if HAS_REQUEST_PREPROCESSOR
+            else "Vector tile layers require QGIS 3.22 or later"
+        )
+        add_tiles_action.setEnabled(HAS_REQUEST_PREPROCESSOR)
+        add_tiles_action.triggered.connect(self.add_tiles_layer)
+        actions.append(add_tiles_action)
+
         add_layer_filtered_action = QAction(
             QIcon(), "Add Layer Using Filter...", parent
         )
         add_layer_filtered_action.triggered.connect(self.add_layer_filtered)
         actions.append(add_layer_filtered_action)
 
+        add_live_layer_action = QAction(QIcon(), "Add Live Layer", parent)
+        add_live_layer_action.setToolTip(
+            "Load only the features in the current map extent, as you pan and zoom"
+        )
+        add_live_layer_action.triggered.connect(self.add_live_layer)
+        actions.append(add_live_layer_action)
+
+        preview_density_action = QAction(QIcon(), "Preview Density...", parent)
+        preview_density_action.triggered.connect(self.preview_density)
+        actions.append(preview_density_action)
+
         table_info_action = QAction(QIcon(), "Table Info...", parent)
         table_info_action.triggered.connect(self.table_info_action)
         actions.append(table_info_action)
@@ -263,6 +480,55 @@ class TableItem(QgsDataItem):
         dlg.setMessage(html, QgsMessageOutput.MessageHtml)
         dlg.showMessage()
 
+    def preview_density(self):
+        dlg = DensityPreviewDialog(self.table)
+        ret = dlg.exec_()
+        if ret != QDialog.Accepted:
+            return
+
+        task = DensityPreviewTask(self.table, dlg.cell_size, dlg.aggregate_column)
+
+        def _show_terminated_message():
+            iface.messageBar().pushMessage(
+                f"Density preview failed or was canceled ({self.table.name})",
+                level=Qgis.Warning,
+                duration=5,
+            )
+
+        task.taskTerminated.connect(_show_terminated_message)
+        task.taskCompleted.connect(partial(self._add_density_layer, task))
+
+        self.tasks.append(task)
+
+        TASK_SCHEDULER.add_task(task, self.table.schema.database.connection.name)
+
+    def _add_density_layer(self, task):
+        self.tasks.remove(task)
+        layer = task.layer
+        if layer.featureCount() == 0:
+            iface.messageBar().pushMessage(
+                "The table has no features to preview",
+                level=Qgis.Warning,
+                duration=10,
+            )
+            return
+
+        renderer = QgsGraduatedSymbolRenderer("feature_count")
+        renderer.updateClasses(layer, QgsGraduatedSymbolRenderer.Quantile, 5)
+        color_ramp = QgsStyle.defaultStyle().colorRamp("Reds")
+        if color_ramp is not None:
+            renderer.updateColorRamp(color_ramp)
+        layer.setRenderer(renderer)
+        layer.setOpacity(0.7)
+        QgsProject.instance().addMapLayer(layer)
+
+        if task.truncated:
+            iface.messageBar().pushMessage(
+                "Only the first cells are shown. Use a larger cell size to see the whole table",
+                level=Qgis.Warning,
+                duration=10,
+            )
+
     def add_layer_filtered(self):
         dlg = DownloadFilteredLayerDialog(
             self.table, self.table.schema.database.connection
@@ -270,16 +536,63 @@ class TableItem(QgsDataItem):
         dlg.show()
         ret = dlg.exec_()
         if ret == QDialog.Accepted:
-            self._add_layer(dlg.where, dlg.limit)
+            self._add_layer(
+                dlg.where,
+                dlg.limit,
+                dlg.simplify_tolerance,
+                dlg.columns,
+                dlg.sample_size,
+                dlg.sample_seed,
+            )
 
     def add_layer(self):
         self._add_layer(None)
 
-    def _add_layer(self, where=None, limit=None):
+    def add_tiles_layer(self):
+        try:
+            tilejson = self.table.tileset()
+            uri = QgsDataSourceUri()
+            uri.setParam("type", "xyz")
+            uri.setParam("url", tilejson["tiles"][0])
+            uri.setParam("zmin", str(tilejson.get("minzoom", 0)))
+            uri.setParam("zmax", str(tilejson.get("maxzoom", 14)))
+        except Exception as e:
+            error(f"Could not create tileset for {self.table.name}: {e}")
+            iface.messageBar().pushMessage(
+                f"Could not create a tileset for {self.table.name}",
+                level=Qgis.Warning,
+                duration=5,
+            )
+            return
+        # the token isn't part of the layer source, so it isn't saved in
+        # projects. It is added to the tile requests by CARTO_API.add_auth_header
+        layer = QgsVectorTileLayer(bytes(uri.encodedUri()).decode(), self.table.name)
+        QgsProject.instance().addMapLayer(layer)
+
+    def add_live_layer(self):
+        add_live_layer(self.table)
+
+    def _add_layer(
+        self,
+        where=None,
+        limit=None,
+        simplify_tolerance=None,
+        columns=None,
+        sample_size=None,
+        sample_seed=0,
+    ):
         where = where or "TRUE"
         limit = limit or MAX_ROWS
 
-        task = DownloadTableTask(self.table, where, limit)
+        task = DownloadTableTask(
+            self.table,
+            where,
+            limit,
+            simplify_tolerance,
+            columns,
+            sample_size,
+            sample_seed,
+        )
 
         def _show_terminated_message():
             iface.messageBar().pushMessage(
@@ -293,11 +606,15 @@ class TableItem(QgsDataItem):
 
         self.tasks.append(task)
 
-        QgsApplication.taskManager().addTask(task)
+        started = TASK_SCHEDULER.add_task(
+            task, self.table.schema.database.connection.name
+        )
         QCoreApplication.processEvents()
         iface.messageBar().pushMessage(
             "",
-            "Download task added to QGIS task manager",
+            "Download task added to QGIS task manager"
+            if started
+            else "Download task queued, it will start when other tasks finish",
             level=Qgis.Info,
             duration=5,
         )
@@ -314,7 +631,14 @@ class TableItem(QgsDataItem):
 
         QgsProject.instance().addMapLayer(layer)
         metadata = layer_metadata(layer)
-        if not metadata["can_write"]:
+        if metadata.get("simplify_tolerance"):
+            iface.messageBar().pushMessage(
+                "Read-only",
+                "Geometries were simplified. Local changes will not be saved to the original table",
+                level=Qgis.Warning,
+                duration=10,
+            )
+        elif not metadata["can_write"]:
             iface.messageBar().pushMessage(
                 "Read-only",
                 "No permission to write. Local changes will not be saved to the original table",
@@ -323,8 +647,12 @@ class TableItem(QgsDataItem):
             )
             return
 
-        # Get layer extent and handle CRS
-        extent = layer.extent()
+        # Get layer extent and handle CRS. The extent is computed when the
+        # layer is downloaded, so the features don't have to be read again
+        if metadata.get("extent"):
+            extent = QgsRectangle(*metadata["extent"])
+        else:
+            extent = layer.extent()
         if layer.crs() != iface.mapCanvas().mapSettings().destinationCrs():
             transform = QgsCoordinateTransform(
                 layer.crs(),
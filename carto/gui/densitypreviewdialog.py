@@ -0,0 +1,68 @@
+import os
+
+from qgis.core import Qgis
+from qgis.gui import QgsMessageBar
+from qgis.utils import iface
+
+from qgis.PyQt import uic
+from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtWidgets import QDialog, QSizePolicy
+
+from carto.core.utils import qgis_type_from_provider_data_type, DECIMAL_TYPES
+
+WIDGET, BASE = uic.loadUiType(
+    os.path.join(os.path.dirname(__file__), "densitypreviewdialog.ui")
+)
+
+NUMERIC_TYPES = [QVariant.Int, QVariant.LongLong, QVariant.Double]
+
+
+class DensityPreviewDialog(BASE, WIDGET):
+    def __init__(self, table, parent=None):
+        parent = parent or iface.mainWindow()
+        super(QDialog, self).__init__(parent)
+        self.setupUi(self)
+        self.table = table
+        self.cell_size = None
+        self.aggregate_column = None
+
+        self.bar = QgsMessageBar()
+        self.bar.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Fixed)
+        self.layout().addWidget(self.bar)
+
+        self.buttonBox.accepted.connect(self.okClicked)
+        self.buttonBox.rejected.connect(self.reject)
+
+        self.initGui()
+
+    def initGui(self):
+        self.comboAggregateColumn.addItem("")
+        self.comboAggregateColumn.addItems(
+            [
+                column["name"]
+                for column in self.table.columns()
+                if self._is_numeric(column["type"])
+            ]
+        )
+
+    def _is_numeric(self, data_type):
+        # large decimals are read as strings, but can still be aggregated
+        # in the warehouse
+        if data_type.lower().split("(")[0].strip() in DECIMAL_TYPES:
+            return True
+        provider_type = self.table.schema.database.connection.provider_type
+        return qgis_type_from_provider_data_type(data_type, provider_type) in NUMERIC_TYPES
+
+    def okClicked(self):
+        try:
+            self.cell_size = float(self.txtCellSize.text())
+        except ValueError:
+            self.bar.pushMessage("Invalid cell size", Qgis.Warning, duration=5)
+            return
+        if self.cell_size <= 0:
+            self.bar.pushMessage(
+                "Cell size must be greater than zero", Qgis.Warning, duration=5
+            )
+            return
+        self.aggregate_column = self.comboAggregateColumn.currentText() or None
+        self.accept()
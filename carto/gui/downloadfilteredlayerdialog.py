@@ -13,10 +13,10 @@ from qgis.gui import QgsMessageBar
 
 from qgis.PyQt import uic
 from qgis.PyQt.QtCore import Qt
-from qgis.PyQt.QtWidgets import QDialog, QSizePolicy
+from qgis.PyQt.QtWidgets import QDialog, QSizePolicy, QListWidgetItem
 
 from carto.gui.extentselectionpanel import ExtentSelectionPanel
-from carto.core.utils import MAX_ROWS
+from carto.core.utils import MAX_ROWS, spatial_filter_for_provider
 
 
 WIDGET, BASE = uic.loadUiType(
@@ -32,6 +32,10 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
         self.table = table
         self.where = None
         self.limit = None
+        self.simplify_tolerance = None
+        self.columns = None
+        self.sample_size = None
+        self.sample_seed = 0
         self.connection = connection
         self.bar = QgsMessageBar()
         self.bar.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Fixed)
@@ -43,6 +47,20 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
         self.extentPanel = ExtentSelectionPanel(self)
         self.grpSpatialFilter.layout().addWidget(self.extentPanel, 1, 0)
 
+        self.grpColumns.toggled.connect(self.populateColumns)
+
+    def populateColumns(self, checked):
+        if not checked or self.listColumns.count():
+            return
+        geom_column = self.table.geom_column()
+        for column in self.table.columns():
+            if column["name"] == geom_column:
+                continue
+            item = QListWidgetItem(column["name"])
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked)
+            self.listColumns.addItem(item)
+
     def okClicked(self):
         statements = []
         if self.grpSpatialFilter.isChecked():
@@ -64,32 +82,14 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
             rectangle4326 = QgsRectangle(
                 bottom_left.x(), bottom_left.y(), top_right.x(), top_right.y()
             )
-            if self.connection.provider_type == "databricksRest":
-                statements.append(
-                    f"ST_INTERSECTS(ST_GEOMFROMWKB({geom_column}), ST_GEOMFROMTEXT('{rectangle4326.asWktPolygon()}'))"
-                )
-            elif self.connection.provider_type in ["postgres", "redshift"]:
-                statements.append(
-                    f"""CASE
-                        WHEN ST_SRID(geom) = 0 THEN
-                            ST_INTERSECTS(
-                                ST_SETSRID({geom_column}, 4326),
-                                ST_SETSRID(ST_GEOMFROMTEXT('{rectangle4326.asWktPolygon()}'), 4326)
-                            )
-                        ELSE
-                            ST_INTERSECTS(
-                                ST_TRANSFORM({geom_column}, 4326),
-                                ST_SETSRID(ST_GEOMFROMTEXT('{rectangle4326.asWktPolygon()}'), 4326)
-                            )
-                        END"""
-                )
-            else:
-                statements.append(
-                    f"ST_INTERSECTS({geom_column}, ST_GEOGFROMTEXT('{rectangle4326.asWktPolygon()}'))"
+            statements.append(
+                spatial_filter_for_provider(
+                    self.connection.provider_type, geom_column, rectangle4326
                 )
+            )
         elif self.grpWhereFilter.isChecked():
             statements.append(self.txtWhere.text())
-        elif not self.grpLimit.isChecked():
+        elif not (self.grpLimit.isChecked() or self.grpSample.isChecked()):
             self.bar.pushMessage("Please select a filter", Qgis.Warning, duration=5)
             return
         else:
@@ -109,4 +109,41 @@ class DownloadFilteredLayerDialog(BASE, WIDGET):
                 return
         else:
             self.limit = MAX_ROWS
+        if self.grpSimplify.isChecked():
+            try:
+                self.simplify_tolerance = float(self.txtTolerance.text())
+            except ValueError:
+                self.bar.pushMessage("Invalid tolerance", Qgis.Warning, duration=5)
+                return
+            if self.simplify_tolerance <= 0:
+                self.bar.pushMessage(
+                    "Tolerance must be greater than zero", Qgis.Warning, duration=5
+                )
+                return
+        else:
+            self.simplify_tolerance = None
+        if self.grpColumns.isChecked():
+            self.columns = [
+                self.listColumns.item(i).text()
+                for i in range(self.listColumns.count())
+                if self.listColumns.item(i).checkState() == Qt.Checked
+            ]
+        else:
+            self.columns = None
+        if self.grpSample.isChecked():
+            try:
+                self.sample_size = int(self.txtSampleSize.text())
+                self.sample_seed = int(self.txtSeed.text() or 0)
+            except ValueError:
+                self.bar.pushMessage(
+                    "Invalid sample size or seed", Qgis.Warning, duration=5
+                )
+                return
+            if self.sample_size <= 0:
+                self.bar.pushMessage(
+                    "Sample size must be greater than zero", Qgis.Warning, duration=5
+                )
+                return
+        else:
+            self.sample_size = None
         self.accept()
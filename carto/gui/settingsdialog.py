@@ -1,6 +1,21 @@
 import os
 
-from carto.core.utils import setting, setSetting, TOKEN
+from carto.core.utils import (
+    setting,
+    setSetting,
+    PREFETCH_CATALOG,
+    TILE_CACHE_SIZE,
+    TILE_CACHE_TTL,
+    REQUEST_TRACE_FILE,
+    PROFILE_TASKS,
+    MEMORY_BUDGET,
+)
+from carto.core.tilecache import (
+    TILE_CACHE,
+    DEFAULT_TILE_CACHE_SIZE,
+    DEFAULT_TILE_CACHE_TTL,
+)
+from qgis.core import Qgis
 from qgis.gui import QgsMessageBar
 
 from qgis.PyQt import uic
@@ -22,12 +37,41 @@ class SettingsDialog(BASE, WIDGET):
 
         self.buttonBox.accepted.connect(self.okClicked)
         self.buttonBox.rejected.connect(self.reject)
+        self.btnClearTileCache.clicked.connect(self.clearTileCache)
+        self.btnRequestTrace.clicked.connect(self.selectRequestTraceFile)
 
         self.setValues()
 
     def setValues(self):
-        self.txtToken.setText(setting(TOKEN))
+        self.chkPrefetchCatalog.setChecked(setting(PREFETCH_CATALOG))
+        tile_cache_size = setting(TILE_CACHE_SIZE)
+        self.spinTileCacheSize.setValue(
+            DEFAULT_TILE_CACHE_SIZE if tile_cache_size is None else tile_cache_size
+        )
+        tile_cache_ttl = setting(TILE_CACHE_TTL)
+        self.spinTileCacheTtl.setValue(
+            DEFAULT_TILE_CACHE_TTL if tile_cache_ttl is None else tile_cache_ttl
+        )
+        self.txtRequestTrace.setText(setting(REQUEST_TRACE_FILE))
+        self.chkProfileTasks.setChecked(setting(PROFILE_TASKS))
+        self.spinMemoryBudget.setValue(setting(MEMORY_BUDGET) or 0)
+
+    def selectRequestTraceFile(self):
+        filename, _ = QFileDialog.getSaveFileName(
+            self, "Request trace file", "", "JSONL files (*.jsonl)"
+        )
+        if filename:
+            self.txtRequestTrace.setText(filename)
+
+    def clearTileCache(self):
+        TILE_CACHE.clear()
+        self.bar.pushMessage("Tile cache cleared", Qgis.Success, duration=5)
 
     def okClicked(self):
-        setSetting(TOKEN, self.txtToken.text())
+        setSetting(PREFETCH_CATALOG, self.chkPrefetchCatalog.isChecked())
+        setSetting(TILE_CACHE_SIZE, self.spinTileCacheSize.value())
+        setSetting(TILE_CACHE_TTL, self.spinTileCacheTtl.value())
+        setSetting(REQUEST_TRACE_FILE, self.txtRequestTrace.text())
+        setSetting(PROFILE_TASKS, self.chkProfileTasks.isChecked())
+        setSetting(MEMORY_BUDGET, self.spinMemoryBudget.value())
         self.accept()
@@ -1,12 +1,21 @@
 import os
 
 from qgis.PyQt.QtWidgets import QApplication
-from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtCore import Qt, QThread
 from qgis.PyQt.QtGui import QIcon
 
 
+def is_main_thread():
+    app = QApplication.instance()
+    return app is not None and QThread.currentThread() == app.thread()
+
+
 def waitcursor(method):
     def func(*args, **kw):
+        # cursor changes are only allowed from the GUI thread. Methods called
+        # from a task or a worker thread just run, without touching the cursor
+        if not is_main_thread():
+            return method(*args, **kw)
         try:
             QApplication.setOverrideCursor(Qt.WaitCursor)
             return method(*args, **kw)
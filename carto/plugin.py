@@ -1,13 +1,19 @@
 import os
 
-from qgis.core import QgsProject, QgsApplication
+from qgis.core import QgsProject, QgsApplication, QgsNetworkAccessManager
 
+from qgis.PyQt.QtCore import Qt
 from qgis.PyQt.QtWidgets import QMenu, QAction
 
 from carto.gui.dataitemprovider import DataItemProvider
 from carto.gui.authorizationsuccessdialog import AuthorizationSuccessDialog
+from carto.gui.settingsdialog import SettingsDialog
+from carto.gui.dashboarddock import DashboardDock
 from carto.core.layers import LayerTracker
-from carto.core.api import CARTO_API
+from carto.core.api import CARTO_API, HAS_REQUEST_PREPROCESSOR
+from carto.core.prefetcher import CATALOG_PREFETCHER
+from carto.core.scheduler import TASK_SCHEDULER
+from carto.processing.provider import CartoProvider
 
 from qgis.utils import iface
 
@@ -16,6 +22,7 @@ from carto.gui.utils import icon
 
 
 CARTO_ICON = icon("carto.svg")
+SETTINGS_ICON = icon("settings.png")
 
 
 class CartoPlugin(object):
@@ -23,8 +30,17 @@ class CartoPlugin(object):
         self.iface = iface
         self.tracker = LayerTracker.instance()
         self.dip = None
+        self.dashboard = None
+        self.provider = None
+        self.request_preprocessor = None
+
+    def initProcessing(self):
+        self.provider = CartoProvider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
 
     def initGui(self):
+        self.initProcessing()
+
         plugins_menu = self.iface.pluginMenu()
         self.carto_menu = QMenu("CARTO")
         self.carto_menu.setIcon(CARTO_ICON)
@@ -32,6 +48,17 @@ class CartoPlugin(object):
 
         self.carto_menu.addAction(AUTHORIZATION_MANAGER.login_action)
 
+        self.settings_action = QAction(SETTINGS_ICON, "Settings…")
+        self.settings_action.triggered.connect(self.show_settings)
+        self.carto_menu.addAction(self.settings_action)
+
+        self.dashboard = DashboardDock(self.iface.mainWindow())
+        self.iface.addDockWidget(Qt.RightDockWidgetArea, self.dashboard)
+        self.dashboard.hide()
+        self.dashboard_action = self.dashboard.toggleViewAction()
+        self.dashboard_action.setText("Performance Dashboard")
+        self.carto_menu.addAction(self.dashboard_action)
+
         self.login_action = QAction()
         self.login_action.setIcon(CARTO_ICON)
         self.login_action.triggered.connect(self.login)
@@ -40,6 +67,11 @@ class CartoPlugin(object):
         self.dip = DataItemProvider()
         QgsApplication.instance().dataItemProviderRegistry().addProvider(self.dip)
 
+        if HAS_REQUEST_PREPROCESSOR:
+            self.request_preprocessor = QgsNetworkAccessManager.setRequestPreprocessor(
+                CARTO_API.add_auth_header
+            )
+
         QgsProject.instance().layerRemoved.connect(self.tracker.layer_removed)
         QgsProject.instance().layerWasAdded.connect(self.tracker.layer_added)
 
@@ -47,6 +79,20 @@ class CartoPlugin(object):
         QgsApplication.instance().dataItemProviderRegistry().removeProvider(self.dip)
         self.dip = None
 
+        QgsApplication.processingRegistry().removeProvider(self.provider)
+        self.provider = None
+
+        if self.request_preprocessor is not None:
+            QgsNetworkAccessManager.removeRequestPreprocessor(self.request_preprocessor)
+            self.request_preprocessor = None
+
+        CATALOG_PREFETCHER.shutdown()
+        TASK_SCHEDULER.cancel_waiting()
+
+        self.iface.removeDockWidget(self.dashboard)
+        self.dashboard.deleteLater()
+        self.dashboard = None
+
         QgsProject.instance().layerRemoved.disconnect(self.tracker.layer_removed)
         QgsProject.instance().layerWasAdded.disconnect(self.tracker.layer_added)
 
@@ -55,6 +101,10 @@ class CartoPlugin(object):
         self.iface.webMenu().removeAction(self.carto_menu.menuAction())
         self.carto_menu = None
 
+    def show_settings(self):
+        dlg = SettingsDialog(iface.mainWindow())
+        dlg.exec_()
+
     def login(self):
         if AUTHORIZATION_MANAGER.is_authorized():
             try:
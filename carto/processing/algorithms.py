@@ -0,0 +1,385 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingContext,
+    QgsProcessingException,
+    QgsProcessingParameterString,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterMultipleLayers,
+    QgsProcessingOutputMultipleLayers,
+    QgsProcessingOutputString,
+)
+
+from carto.core.api import CARTO_API
+from carto.core.connection import CARTO_CONNECTION
+from carto.core.downloadtabletask import DownloadTableTask
+from carto.core.importlayertask import ImportLayerTask
+from carto.core.layers import filepath_for_table, table_metadata
+from carto.core.memory import max_workers
+from carto.core.scheduler import MAX_TASKS, MAX_TASKS_PER_CONNECTION
+from carto.core.utils import MAX_ROWS
+from carto.gui.utils import icon
+
+TOKEN_VARIABLE = "CARTO_API_TOKEN"
+
+
+def _authorize():
+    """
+    Uses the session of the plugin if the user is logged in. Otherwise,
+    as when running from qgis_process, an API access token can be set in
+    an environment variable
+    """
+    if CARTO_API.is_logged_in():
+        return
+    token = os.environ.get(TOKEN_VARIABLE)
+    if not token:
+        raise QgsProcessingException(
+            f"Log in to CARTO, or set the {TOKEN_VARIABLE} environment variable"
+        )
+    CARTO_API.set_token(token)
+    CARTO_API.configure_endpoints()
+
+
+def _find(items, name, id_attribute, description):
+    for item in items:
+        if name in (item.name, getattr(item, id_attribute)):
+            return item
+    raise QgsProcessingException(f"{description} not found: {name}")
+
+
+def find_schema(path):
+    """
+    Returns the schema for a 'connection.database.schema' path
+    """
+    parts = path.strip().rsplit(".", 2)
+    if len(parts) != 3:
+        raise QgsProcessingException(
+            f"Schemas must be given as connection.database.schema: {path}"
+        )
+    connection_name, database_name, schema_name = parts
+    connection = next(
+        (c for c in CARTO_CONNECTION.provider_connections() if c.name == connection_name),
+        None,
+    )
+    if connection is None:
+        raise QgsProcessingException(f"Connection not found: {connection_name}")
+    database = _find(connection.databases(), database_name, "databaseid", "Database")
+    return _find(database.schemas(), schema_name, "schemaid", "Schema")
+
+
+def find_tables(text):
+    """
+    Returns the tables in a list of 'connection.database.schema.table'
+    paths, separated by commas or line breaks
+    """
+    tables = []
+    for path in re.split(r"[,\n]", text):
+        if not path.strip():
+            continue
+        parts = path.strip().rsplit(".", 1)
+        if len(parts) != 2:
+            raise QgsProcessingException(
+                f"Tables must be given as connection.database.schema.table: {path}"
+            )
+        schema = find_schema(parts[0])
+        tables.append(_find(schema.tables(), parts[1], "tableid", "Table"))
+    if not tables:
+        raise QgsProcessingException("No tables were given")
+    return tables
+
+
+def run_tasks(tasks, feedback):
+    """
+    Runs the tasks of the given (connection name, task) pairs concurrently,
+    with the same per-connection and total limits of the task scheduler.
+    Returns the tasks that succeeded
+    """
+    semaphores = {
+        name: threading.Semaphore(MAX_TASKS_PER_CONNECTION) for name, _ in tasks
+    }
+
+    def _run(connection_name, task):
+        with semaphores[connection_name]:
+            if feedback.isCanceled():
+                return False
+            feedback.pushInfo(f"{task.description()} started")
+            return task.run()
+
+    executor = ThreadPoolExecutor(
+        max_workers=max_workers(MAX_TASKS), thread_name_prefix="carto-processing"
+    )
+    try:
+        futures = {executor.submit(_run, name, task): task for name, task in tasks}
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.5)
+            if feedback.isCanceled():
+                for task in futures.values():
+                    task.cancel()
+            feedback.setProgress(
+                sum(task.progress() for task in futures.values()) / len(futures)
+            )
+    finally:
+        executor.shutdown(wait=True)
+
+    succeeded = []
+    for future, task in futures.items():
+        if future.result():
+            feedback.pushInfo(f"{task.description()} finished")
+            succeeded.append(task)
+        elif not feedback.isCanceled():
+            feedback.reportError(f"{task.description()} failed\n{task.exception}")
+    if feedback.isCanceled():
+        raise QgsProcessingException("Canceled")
+    return succeeded
+
+
+class CartoAlgorithm(QgsProcessingAlgorithm):
+    def createInstance(self):
+        return self.__class__()
+
+    def group(self):
+        return "Tables"
+
+    def groupId(self):
+        return "tables"
+
+    def icon(self):
+        return icon("carto.svg")
+
+
+class DownloadTablesAlgorithm(CartoAlgorithm):
+    TABLES = "TABLES"
+    OUTPUT = "OUTPUT"
+
+    def name(self):
+        return "downloadtables"
+
+    def displayName(self):
+        return "Download tables"
+
+    def shortHelpString(self):
+        return (
+            "Downloads one or more tables to local layers that can be edited, "
+            "with changes saved back to the tables. Tables are given as "
+            "connection.database.schema.table, separated by commas or line "
+            "breaks, and are downloaded concurrently."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterString(self.TABLES, "Tables", multiLine=True)
+        )
+        self.addOutput(
+            QgsProcessingOutputMultipleLayers(self.OUTPUT, "Downloaded layers")
+        )
+
+    def download_options(self, table, parameters, context):
+        """
+        Returns the arguments used to create the download task of a table
+        """
+        return {"where": "TRUE", "limit": MAX_ROWS}
+
+    def processAlgorithm(self, parameters, context, feedback):
+        _authorize()
+        tables = find_tables(self.parameterAsString(parameters, self.TABLES, context))
+        tasks = [
+            (
+                table.schema.database.connection.name,
+                DownloadTableTask(
+                    table, **self.download_options(table, parameters, context)
+                ),
+            )
+            for table in tables
+        ]
+        self._layers = {}
+        for task in run_tasks(tasks, feedback):
+            if task.layer is None:
+                feedback.pushInfo(f"{task.table.name} has no rows to download")
+                continue
+            self._layers[task.layer.source()] = task.table.name
+        return {self.OUTPUT: list(self._layers)}
+
+    def postProcessAlgorithm(self, context, feedback):
+        # layers of the downloaded tables that are already in the project
+        # are reloaded, so they show the new contents of the tables, and the
+        # rest are added to it
+        sources = dict(self._layers)
+        if context.project() is None:
+            return {self.OUTPUT: list(self._layers)}
+        for layer in context.project().mapLayers().values():
+            if layer.source() in sources:
+                del sources[layer.source()]
+                if not layer.isEditable():
+                    layer.dataProvider().reloadData()
+                    layer.triggerRepaint()
+        for source, name in sources.items():
+            context.addLayerToLoadOnCompletion(
+                source,
+                QgsProcessingContext.LayerDetails(name, context.project(), self.OUTPUT),
+            )
+        return {self.OUTPUT: list(self._layers)}
+
+
+class DownloadFilteredTablesAlgorithm(DownloadTablesAlgorithm):
+    WHERE = "WHERE"
+    LIMIT = "LIMIT"
+    SIMPLIFY_TOLERANCE = "SIMPLIFY_TOLERANCE"
+
+    def name(self):
+        return "downloadfilteredtables"
+
+    def displayName(self):
+        return "Download filtered tables"
+
+    def shortHelpString(self):
+        return (
+            "Downloads the rows of one or more tables that match a SQL filter, "
+            "up to a maximum number of rows. Geometries can be simplified, in "
+            "which case changes to the layers are not saved back to the tables."
+        )
+
+    def initAlgorithm(self, config=None):
+        super().initAlgorithm(config)
+        self.addParameter(
+            QgsProcessingParameterString(self.WHERE, "Filter (SQL WHERE clause)", "TRUE")
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.LIMIT, "Maximum number of rows", defaultValue=MAX_ROWS, minValue=1
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SIMPLIFY_TOLERANCE,
+                "Simplification tolerance",
+                QgsProcessingParameterNumber.Double,
+                optional=True,
+                minValue=0,
+            )
+        )
+
+    def download_options(self, table, parameters, context):
+        simplify_tolerance = None
+        if parameters.get(self.SIMPLIFY_TOLERANCE) is not None:
+            simplify_tolerance = self.parameterAsDouble(
+                parameters, self.SIMPLIFY_TOLERANCE, context
+            )
+        return {
+            "where": self.parameterAsString(parameters, self.WHERE, context) or "TRUE",
+            "limit": self.parameterAsInt(parameters, self.LIMIT, context),
+            "simplify_tolerance": simplify_tolerance or None,
+        }
+
+
+class RefreshTablesAlgorithm(DownloadTablesAlgorithm):
+    def name(self):
+        return "refreshtables"
+
+    def displayName(self):
+        return "Refresh tables"
+
+    def shortHelpString(self):
+        return (
+            "Downloads again tables that were already downloaded, with the same "
+            "filter, columns, simplification and sampling, replacing the local "
+            "layers with the current contents of the tables."
+        )
+
+    def download_options(self, table, parameters, context):
+        metadata = table_metadata(
+            filepath_for_table(
+                table.schema.database.connection.name,
+                table.schema.database.databaseid,
+                table.schema.schemaid,
+                table.tableid,
+            )
+        )
+        if metadata is None:
+            raise QgsProcessingException(f"{table.name} hasn't been downloaded")
+        sample = metadata.get("sample") or {}
+        return {
+            "where": metadata.get("where", "TRUE"),
+            "limit": metadata.get("limit", MAX_ROWS),
+            "simplify_tolerance": metadata.get("simplify_tolerance"),
+            "columns": metadata.get("projected_columns"),
+            "sample_size": sample.get("size"),
+            "sample_seed": sample.get("seed", 0),
+        }
+
+
+class ImportLayersAlgorithm(CartoAlgorithm):
+    INPUT = "INPUT"
+    SCHEMA = "SCHEMA"
+    OVERWRITE = "OVERWRITE"
+    OUTPUT = "OUTPUT"
+
+    def name(self):
+        return "importlayers"
+
+    def displayName(self):
+        return "Import layers"
+
+    def shortHelpString(self):
+        return (
+            "Imports one or more layers to tables in a schema, given as "
+            "connection.database.schema. Tables are named after the layers, "
+            "without the characters that are not letters or digits. Existing "
+            "tables with the same name are only replaced if overwriting is "
+            "enabled."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+                self.INPUT, "Layers", QgsProcessing.TypeVectorAnyGeometry
+            )
+        )
+        self.addParameter(QgsProcessingParameterString(self.SCHEMA, "Schema"))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.OVERWRITE, "Overwrite existing tables", defaultValue=False
+            )
+        )
+        self.addOutput(QgsProcessingOutputString(self.OUTPUT, "Imported tables"))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        _authorize()
+        schema = find_schema(self.parameterAsString(parameters, self.SCHEMA, context))
+        connection = schema.database.connection
+        overwrite = self.parameterAsBoolean(parameters, self.OVERWRITE, context)
+        existing = {table.tableid.lower() for table in schema.tables()}
+        tablenames = set()
+        tasks = []
+        for layer in self.parameterAsLayerList(parameters, self.INPUT, context):
+            tablename = "".join([c for c in layer.name() if c.isalnum()])
+            if not tablename:
+                raise QgsProcessingException(
+                    f"{layer.name()} has no letters or digits to name its table"
+                )
+            if tablename.lower() in tablenames:
+                raise QgsProcessingException(
+                    f"More than one layer would be imported to the {tablename} table"
+                )
+            if tablename.lower() in existing and not overwrite:
+                raise QgsProcessingException(
+                    f"The {tablename} table already exists, enable overwriting "
+                    "to replace it"
+                )
+            tablenames.add(tablename.lower())
+            fqn = f"{schema.database.databaseid}.{schema.schemaid}.{tablename}"
+            tasks.append(
+                (
+                    connection.name,
+                    ImportLayerTask(connection.name, connection.provider_type, fqn, layer),
+                )
+            )
+        imported = [task.fqn for task in run_tasks(tasks, feedback)]
+        schema.clear_tables_cache()
+        return {self.OUTPUT: "\n".join(imported)}
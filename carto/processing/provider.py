@@ -0,0 +1,31 @@
+from qgis.core import QgsProcessingProvider
+
+from carto.gui.utils import icon
+from carto.processing.algorithms import (
+    DownloadTablesAlgorithm,
+    DownloadFilteredTablesAlgorithm,
+    RefreshTablesAlgorithm,
+    ImportLayersAlgorithm,
+)
+
+
+class CartoProvider(QgsProcessingProvider):
+    """
+    Processing provider with the CARTO algorithms, so tables can be
+    downloaded and imported from models, scripts and qgis_process
+    """
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(DownloadTablesAlgorithm())
+        self.addAlgorithm(DownloadFilteredTablesAlgorithm())
+        self.addAlgorithm(RefreshTablesAlgorithm())
+        self.addAlgorithm(ImportLayersAlgorithm())
+
+    def id(self):
+        return "carto"
+
+    def name(self):
+        return "CARTO"
+
+    def icon(self):
+        return icon("carto.svg")
@@ -0,0 +1,41 @@
+import pytest
+
+from qgis.PyQt.QtCore import QVariant
+
+from carto.core.utils import (
+    provider_data_type_from_qgis_type,
+    qgis_type_from_provider_data_type,
+)
+
+
+@pytest.mark.parametrize("qgis_type", [QVariant.Int, QVariant.LongLong])
+def test_snowflake_integers_round_trip(qgis_type):
+    data_type = provider_data_type_from_qgis_type(qgis_type, "snowflake")
+    assert data_type == "NUMBER(38,0)"
+    assert (
+        qgis_type_from_provider_data_type(data_type, "snowflake") == QVariant.LongLong
+    )
+
+
+def test_snowflake_result_integers():
+    # integer columns in the schema of Snowflake results
+    assert (
+        qgis_type_from_provider_data_type("fixed", "snowflake", 38, 0)
+        == QVariant.LongLong
+    )
+
+
+@pytest.mark.parametrize(
+    "data_type, provider, qgis_type",
+    [
+        ("NUMBER(10,2)", "snowflake", QVariant.Double),
+        ("NUMERIC(10)", "postgres", QVariant.LongLong),
+        ("DECIMAL(18,0)", "redshift", QVariant.LongLong),
+        ("NUMERIC(38,0)", "postgres", QVariant.String),
+        ("BIGNUMERIC(76,0)", "bigquery", QVariant.String),
+        ("NUMERIC", "postgres", QVariant.Double),
+        ("INT64", "bigquery", QVariant.LongLong),
+    ],
+)
+def test_decimals(data_type, provider, qgis_type):
+    assert qgis_type_from_provider_data_type(data_type, provider) == qgis_type